@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# Run a local stand-in for the APIs used by the extractors. Set REPLAY Mode=server in config.ini to use it
+
+import lyf, logging
+import argparse
+
+from lyf import standin
+
+parser = argparse.ArgumentParser(description="Serve recorded or synthetic API responses locally")
+parser.add_argument("-p", "--port", type=int, default=8808, help="Port to listen on.")
+parser.add_argument("-d", "--dir", default=None, help="Directory of recorded responses. Defaults to REPLAY Dir.")
+parser.add_argument("-l", "--latency", type=float, default=0, help="Seconds to wait before every response.")
+parser.add_argument("--no-synthetic", action='store_true', help="Only serve recorded responses.")
+parser.add_argument("--ga-rows", type=int, default=10000, help="Rows returned by every synthetic GA query.")
+parser.add_argument("--items", type=int, default=100, help="Items in each synthetic Facebook edge, YouTube channel and MailChimp collection.")
+parser.add_argument("--page-size", type=int, default=25, help="Page size of synthetic Facebook edges.")
+parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic values.")
+
+def main():
+	args = parser.parse_args()
+	synthetic = None
+	if not args.no_synthetic:
+		synthetic = standin.Synthetic(args.ga_rows, args.items, args.page_size, args.seed)
+
+	server = standin.StandinServer(args.port, args.dir, synthetic, args.latency)
+	logging.info('Stand-in API server listening on port %s.' % args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+if __name__ == '__main__':
+	lyf.setup_logging()
+	main()
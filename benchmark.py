@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+# Benchmark the load paths against a local database with synthetic GA and social data, reporting throughput, latency
+# percentiles and peak memory, and comparing the results with stored baselines
+import lyf, logging
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import tempfile
+import multiprocessing
+
+from lyf import psql, bench
+
+parser = argparse.ArgumentParser(description="Benchmark the ETL load paths with synthetic data")
+parser.add_argument("-b", "--bench", nargs='+', default=None, help="Only run these benchmarks.")
+parser.add_argument("-s", "--scales", default='10k,100k', help="Comma separated numbers of rows, e.g. 10k,100k,1m,10m.")
+parser.add_argument("--batch-size", type=int, default=10000, help="Rows per batch for the bulk load paths.")
+parser.add_argument("--max-row-ops", type=int, default=100000, help="Largest scale to run the row at a time paths at.")
+parser.add_argument("--baseline", default=bench.BASELINE_FILE, help="File of stored baselines.")
+parser.add_argument("--save-baseline", action='store_true', help="Store the results as the new baselines.")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional change from the baseline counted as a regression.")
+parser.add_argument("-o", "--output", default=None, help="File to write the JSON results to.")
+
+# Schema holding copies of the production tables for the PostgreSQL benchmarks, so real data is never touched
+BENCH_SCHEMA = 'lyf_bench'
+
+# Split an iterable into lists of up to size items
+def chunks(iterable, size):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) >= size:
+			yield chunk
+			chunk = []
+	if len(chunk) > 0:
+		yield chunk
+
+# Raise if a call loaded a different number of rows than it was given, so that a broken load path is reported as
+# an error rather than timed and saved as a baseline
+def check_rows(name, loaded, expected):
+	if loaded != expected:
+		raise Exception('%s loaded %s/%s rows.' % (name, loaded, expected))
+
+# Create an empty copy of a table in the benchmark schema. Returns its qualified name
+def bench_table(db, table):
+	name = '%s.%s' % (BENCH_SCHEMA, table)
+	db.execute('CREATE SCHEMA IF NOT EXISTS %s;' % BENCH_SCHEMA)
+	db.execute('DROP TABLE IF EXISTS %s;' % name)
+	if not db.execute('CREATE TABLE %s (LIKE %s INCLUDING ALL);' % (name, psql.qualify_schema(table)), commit=True):
+		raise Exception('Could not create %s.' % name)
+	return(name)
+
+# Fill a benchmark table without timing it
+def fill_table(db, table, rows, batch_size):
+	name = bench_table(db, table)
+	success, failed = db.insert_many(name, rows, batch_size)
+	check_rows(name, success, success + failed)
+	db.conn.commit()
+	return(name)
+
+# DB.insert, one statement per fact row
+def bench_insert(db, timer, scale, batch_size):
+	table = bench_table(db, 'f_ga_daily')
+	for row in bench.ga_fact_rows(scale):
+		check_rows('insert', timer.time(1, db.insert, table, row), 1)
+	db.conn.commit()
+
+# DB.insert_many, copying batches of fact rows
+def bench_insert_many(db, timer, scale, batch_size):
+	table = bench_table(db, 'f_ga_daily')
+	for batch in chunks(bench.ga_fact_rows(scale), batch_size):
+		success, failed = timer.time(len(batch), db.insert_many, table, batch, batch_size)
+		check_rows('insert_many', success, len(batch))
+	db.conn.commit()
+
+# DB.upsert, one statement per YouTube snapshot row, with every other day already loaded
+def bench_upsert(db, timer, scale, batch_size):
+	table = fill_table(db, 'f_youtube_daily', (row for row in bench.youtube_rows(scale) if (row['date_id'] % 2) == 0), batch_size)
+	for row in bench.youtube_rows(scale):
+		check_rows('upsert', timer.time(1, db.upsert, table, row, ['date_id', 'video_id']), 1)
+	db.conn.commit()
+
+# DB.upsert_many through a staging table, with every other day already loaded
+def bench_upsert_many(db, timer, scale, batch_size):
+	table = fill_table(db, 'f_youtube_daily', (row for row in bench.youtube_rows(scale) if (row['date_id'] % 2) == 0), batch_size)
+	for batch in chunks(bench.youtube_rows(scale), batch_size):
+		inserted, updated = timer.time(len(batch), db.upsert_many, table, batch, ['date_id', 'video_id'], batch_size)
+		check_rows('upsert_many', inserted + updated, len(batch))
+	db.conn.commit()
+
+# DB.upsert_many with INSERT ... ON CONFLICT, for MailChimp list snapshots
+def bench_upsert_many_on_conflict(db, timer, scale, batch_size):
+	table = fill_table(db, 'f_mc_lists_daily', (row for row in bench.mc_list_rows(scale) if (row['date_id'] % 2) == 0), batch_size)
+	for batch in chunks(bench.mc_list_rows(scale), batch_size):
+		inserted, updated = timer.time(len(batch), db.upsert_many, table, batch, ['date_id', 'list_id'], batch_size, on_conflict=True)
+		check_rows('upsert_many', inserted + updated, len(batch))
+	db.conn.commit()
+
+# DB.query, reading a day of facts at a time into dictionaries
+def bench_query(db, timer, scale, batch_size):
+	table = fill_table(db, 'f_ga_daily', bench.ga_fact_rows(scale), batch_size)
+	days = [row['date_id'] for row in db.query('SELECT DISTINCT date_id FROM %s ORDER BY date_id;' % table)]
+	sql = 'SELECT * FROM %s WHERE date_id = %%s;' % table
+	for day in days:
+		results = timer.time(0, db.query, sql, [day])
+		timer.rows += len(results)
+
+# DB.stream, reading every fact through a server-side cursor
+def bench_stream(db, timer, scale, batch_size):
+	table = fill_table(db, 'f_ga_daily', bench.ga_fact_rows(scale), batch_size)
+	rows = timer.time(0, lambda: sum([1 for row in db.stream('SELECT * FROM %s;' % table)]))
+	timer.rows += rows
+
+# DimCache.resolve, looking up the surrogate keys of each page of GA source values from a preloaded dimension. The
+# preload is not timed, so that the latencies are those of the lookups alone
+def bench_lookup(db, timer, scale, batch_size, cache_size=None):
+	table = fill_table(db, 'd_ga_source', bench.ga_source_rows(bench.dim_size(scale, bench.GA_SOURCE_RATIO)), batch_size)
+	cache = psql.DimCache(db, table, 'source_medium', 'source_id', cache_size)
+	for page in chunks(bench.ga_fact_results(scale), batch_size):
+		timer.time(len(page), cache.resolve, [row[2] for row in page])
+
+# DimCache.resolve with a bounded cache, fetching uncached values in a query per page
+def bench_lookup_lru(db, timer, scale, batch_size):
+	bench_lookup(db, timer, scale, batch_size, max(1, bench.dim_size(scale, bench.GA_SOURCE_RATIO) // 10))
+
+# DB.load_csv, loading the geography dimension from a CSV file
+def bench_load_csv(db, timer, scale, batch_size):
+	table = bench_table(db, 'd_ga_geo')
+	csv_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+	try:
+		writer = None
+		for row in bench.ga_geo_rows(scale):
+			if writer is None:
+				writer = csv.DictWriter(csv_file, row.keys())
+				writer.writeheader()
+			writer.writerow(row)
+		csv_file.close()
+		success, failed = timer.time(scale, db.load_csv, table, csv_file.name)
+		check_rows('load_csv', success, scale)
+		db.conn.commit()
+	finally:
+		os.remove(csv_file.name)
+
+# psql.load_ga_fact, resolving the keys of raw GA pages against all three dimensions and copying them into the fact
+def bench_load_ga_fact(db, timer, scale, batch_size):
+	geo = fill_table(db, 'd_ga_geo', bench.ga_geo_rows(bench.dim_size(scale, bench.GA_GEO_RATIO)), batch_size)
+	source = fill_table(db, 'd_ga_source', bench.ga_source_rows(bench.dim_size(scale, bench.GA_SOURCE_RATIO)), batch_size)
+	page = fill_table(db, 'd_ga_page', bench.ga_page_rows(bench.dim_size(scale, bench.GA_PAGE_RATIO)), batch_size)
+	table = bench_table(db, 'f_ga_daily')
+
+	caches = (psql.DimCache(db, geo, 'city_id', 'geo_id'), psql.DimCache(db, source, 'source_medium', 'source_id'), \
+		psql.DimCache(db, page, 'page_title', 'page_id'))
+	for results in chunks(bench.ga_fact_results(scale), batch_size):
+		inserted, extracted = timer.time(len(results), psql.load_ga_fact, db, [results], table=table, caches=caches)
+		check_rows('load_ga_fact', inserted, len(results))
+	db.conn.commit()
+
+# mysql.merge_into_table, one statement per source dimension row, into a copy of d_ga_source
+def bench_mysql_merge(db, timer, scale, batch_size):
+	from lyf import mysql
+	conn = mysql.connect()
+	try:
+		conn.query('DROP TABLE IF EXISTS bench_d_ga_source;')
+		conn.query('CREATE TABLE bench_d_ga_source LIKE d_ga_source;')
+		for row in bench.ga_source_rows(scale):
+			timer.time(1, mysql.merge_into_table, conn, 'bench_d_ga_source', row, ['source_medium'])
+		conn.query('DROP TABLE bench_d_ga_source;')
+	finally:
+		conn.close()
+
+# Benchmarks with the function running them, whether they work a row at a time and whether they use PostgreSQL
+BENCHMARKS = collections.OrderedDict([
+	('psql.insert', (bench_insert, True, True)),
+	('psql.insert_many', (bench_insert_many, False, True)),
+	('psql.upsert', (bench_upsert, True, True)),
+	('psql.upsert_many', (bench_upsert_many, False, True)),
+	('psql.upsert_many_on_conflict', (bench_upsert_many_on_conflict, False, True)),
+	('psql.query', (bench_query, False, True)),
+	('psql.stream', (bench_stream, False, True)),
+	('psql.dim_lookup', (bench_lookup, False, True)),
+	('psql.dim_lookup_lru', (bench_lookup_lru, False, True)),
+	('psql.load_csv', (bench_load_csv, False, True)),
+	('psql.load_ga_fact', (bench_load_ga_fact, False, True)),
+	('mysql.merge_into_table', (bench_mysql_merge, True, False))
+])
+
+# Parse a number of rows, allowing k and m suffixes
+def parse_scale(scale):
+	scale = scale.strip().lower()
+	multiplier = { 'k' : 1000, 'm' : 1000000 }.get(scale[-1:], 1)
+	return(int(float(scale.rstrip('km')) * multiplier))
+
+# Run one benchmark in a child process, so that its peak memory is measured on its own
+def run_benchmark(name, scale, batch_size):
+	func, row_ops, postgres = BENCHMARKS[name]
+	queue = multiprocessing.Queue()
+
+	def child():
+		try:
+			db = psql.DB() if postgres else None
+			timer = bench.Timer()
+			try:
+				func(db, timer, scale, batch_size)
+			finally:
+				if db is not None:
+					db.execute('DROP SCHEMA IF EXISTS %s CASCADE;' % BENCH_SCHEMA, commit=True)
+					db.close()
+			queue.put(timer.summary())
+		except Exception as err:
+			queue.put({ 'error' : str(err) })
+
+	process = multiprocessing.Process(target=child)
+	process.start()
+	result = queue.get()
+	process.join()
+	return(result)
+
+def main():
+	args = parser.parse_args()
+	names = args.bench or BENCHMARKS.keys()
+	for name in names:
+		if name not in BENCHMARKS:
+			parser.error('Unknown benchmark: %s' % name)
+
+	results = collections.OrderedDict()
+	for scale in [parse_scale(scale) for scale in args.scales.split(',')]:
+		for name in names:
+			key = '%s@%s' % (name, scale)
+			if BENCHMARKS[name][1] and scale > args.max_row_ops:
+				results[key] = { 'skipped' : 'Row at a time paths only run up to %s rows.' % args.max_row_ops }
+				continue
+			results[key] = run_benchmark(name, scale, args.batch_size)
+			if 'error' in results[key]:
+				logging.error('%s failed: %s' % (key, results[key]['error']))
+			else:
+				logging.info('%s: %s rows/s, p95 %sms, peak %sMB.' % (key, results[key]['rows_per_sec'], \
+					results[key]['p95_ms'], results[key]['peak_mb']))
+
+	found = bench.regressions(results, bench.load_baseline(args.baseline), args.tolerance)
+	for key, measure, base, value in found:
+		logging.error('Regression in %s: %s was %s, now %s.' % (key, measure, base, value))
+
+	report = { 'results' : results, 'regressions' : [list(regression) for regression in found] }
+	if args.output is None:
+		print(json.dumps(report, indent=2))
+	else:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+
+	if args.save_baseline:
+		bench.save_baseline(results, args.baseline)
+		logging.info('Saved baselines to %s.' % args.baseline)
+	elif len(found) > 0:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	lyf.setup_logging()
+	main()
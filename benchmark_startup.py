@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# Benchmark how long each ETL script takes to start, as cron launches them many times a day. Each import is timed in
+# a fresh interpreter, with the API client libraries it loaded, and compared with loading every client library up front
+import lyf, logging
+import argparse
+import collections
+import json
+import subprocess
+import sys
+
+from lyf import bench
+
+parser = argparse.ArgumentParser(description="Benchmark the start up time of the ETL scripts")
+parser.add_argument("-m", "--modules", nargs='+', default=None, help="Only time importing these modules.")
+parser.add_argument("-n", "--repeat", type=int, default=10, help="Fresh interpreters started for each module.")
+parser.add_argument("--baseline", default=bench.BASELINE_FILE, help="File of stored baselines.")
+parser.add_argument("--save-baseline", action='store_true', help="Store the results as the new baselines.")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Fractional change from the baseline counted as a regression.")
+parser.add_argument("-o", "--output", default=None, help="File to write the JSON results to.")
+
+# Client libraries that used to be imported by lyf itself, and are now only imported by the sources that need them
+CLIENT_LIBRARIES = ['tweepy', 'httplib2', 'apiclient.discovery', 'oauth2client.service_account', 'dateutil.parser']
+
+# Modules to time importing. 'python' is the interpreter on its own and 'eager' every client library, as importing
+# lyf used to cost
+STARTUP_MODULES = ['python', 'eager', 'lyf', 'd_mc_campaigns', 'f_mc_lists_daily', 'f_facebook_daily', \
+	'f_twitter_daily', 'f_youtube_daily', 'load_ga_dims', 'load_ga_fact', 'load_ga', 'run_etl']
+
+# Run in the child interpreter, printing the client libraries loaded and its peak memory as JSON. Only modules the
+# interpreter has already loaded are used after the import being timed
+CHILD_CODE = '''
+import sys
+%s
+import json, resource
+print(json.dumps({ 'modules' : [name for name in %r if name in sys.modules], \
+	'maxrss' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }))
+'''
+
+# Gets the code importing a module in a fresh interpreter
+def child_code(module):
+	if module == 'python':
+		imports = 'pass'
+	elif module == 'eager':
+		imports = '\n'.join(['import %s' % name for name in CLIENT_LIBRARIES + ['lyf']])
+	else:
+		imports = 'import %s' % module
+	return(CHILD_CODE % (imports, CLIENT_LIBRARIES))
+
+# Start an interpreter importing a module, returning what it printed
+def start(code):
+	return(subprocess.check_output([sys.executable, '-c', code], cwd=lyf.SCRIPT_DIR, stderr=subprocess.STDOUT))
+
+# Time starting a module a number of times. Throughput is starts per second, and latency the time for each start
+def run_startup(module, repeat):
+	code = child_code(module)
+	timer = bench.Timer()
+	try:
+		for i in xrange(repeat):
+			output = timer.time(1, start, code)
+	except subprocess.CalledProcessError as err:
+		return({ 'error' : err.output.strip().split('\n')[-1] })
+
+	child = json.loads(output.strip().split('\n')[-1])
+	result = timer.summary()
+	result['peak_mb'] = bench.peak_memory_mb(child['maxrss']) # Of the child rather than this process
+	result['libraries'] = child['modules']
+	return(result)
+
+def main():
+	args = parser.parse_args()
+	modules = args.modules or STARTUP_MODULES
+
+	results = collections.OrderedDict()
+	for module in modules:
+		key = 'startup.%s' % module
+		results[key] = run_startup(module, args.repeat)
+		if 'error' in results[key]:
+			logging.error('%s failed: %s' % (key, results[key]['error']))
+		else:
+			logging.info('%s: p50 %sms, peak %sMB, loads %s.' % (key, results[key]['p50_ms'], results[key]['peak_mb'], \
+				', '.join(results[key]['libraries']) or 'no client libraries'))
+
+	# Time saved by importing lyf on its own rather than with every client library, as it used to be
+	saved = None
+	if results.get('startup.eager', {}).get('p50_ms') and results.get('startup.lyf', {}).get('p50_ms'):
+		saved = round(results['startup.eager']['p50_ms'] - results['startup.lyf']['p50_ms'], 3)
+		logging.info('Importing lyf takes %sms less than loading every client library up front.' % saved)
+
+	found = bench.regressions(results, bench.load_baseline(args.baseline), args.tolerance)
+	for key, measure, base, value in found:
+		logging.error('Regression in %s: %s was %s, now %s.' % (key, measure, base, value))
+
+	report = { 'results' : results, 'saved_ms' : saved, 'regressions' : [list(regression) for regression in found] }
+	if args.output is None:
+		print(json.dumps(report, indent=2))
+	else:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+
+	if args.save_baseline:
+		bench.save_baseline(results, args.baseline)
+		logging.info('Saved baselines to %s.' % args.baseline)
+	elif len(found) > 0:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	lyf.setup_logging()
+	main()
@@ -2,25 +2,22 @@
 # MailChimp integration
 
 import lyf, logging
-from lyf import psql
+from lyf import psql, mailchimp
 
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 def main():
 	try:
-		campaigns = lyf.get_mc_campaigns()
+		campaigns = mailchimp.get_mc_campaigns()
 
-		db = psql.DB()
-		i = 0
-		for campaign in campaigns:
-			db.upsert('d_mc_campaigns', campaign.__dict__, ['campaign_id']) # Update dimension
-			i += 1
+		with psql.session() as db:
+			inserted, updated = db.upsert_many('d_mc_campaigns', [campaign.__dict__ for campaign in campaigns], ['campaign_id']) # Update dimension
 
-		db.close()
-		logging.info('Merged %s rows into d_mc_campaigns.' % i)
+		logging.info('Merged %s rows into d_mc_campaigns (%s new).' % (inserted + updated, inserted))
+		return(inserted + updated)
 	except Exception as err:
 		logging.error(err)
 
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
@@ -5,9 +5,8 @@ import requests
 import collections
 import argparse
 
-from lyf import psql
+from lyf import psql, facebook
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 def main():
 	try:
@@ -15,9 +14,14 @@ def main():
 		today = date.today().strftime('%Y-%m-%d')
 		fb_rec['date_id'] = date.today().strftime('%Y%m%d')
 
+		# Send all three queries in one batch request
 		query = 'name,likes,videos{id,likes,description,created_time}'
 		query += ',posts{created_time,id,admin_creator,message}'
-		results = lyf.fb_query(query)
+		new_query = 'name,posts.since(%s){created_time,id,admin_creator,message},videos.since(%s){id,likes,description,created_time}' % (today, today)
+		metrics = [ 'page_impressions', 'page_impressions_unique', 'page_engaged_users', 'page_actions_post_reactions_like_total', 'page_fan_adds_unique', 'page_fan_removes_unique', 'page_views_total', 'page_video_views' ]
+
+		paths = [facebook.fb_query_path(query), facebook.fb_query_path(new_query), facebook.fb_insights_path(metrics, 'day', since=today)]
+		results, new_results, insights = facebook.fb_batch(paths)
 
 		fb_rec['total_likes'] = results['likes']
 		fb_rec['total_posts'] = len(results['posts']['data'])
@@ -28,25 +32,19 @@ def main():
 			totalVidLikes += len(vid['likes']['data'])
 		fb_rec['total_video_likes'] = totalVidLikes
 
-		query = 'name,posts.since(%s){created_time,id,admin_creator,message},videos.since(%s){id,likes,description,created_time}' % (today, today)
-                results = lyf.fb_query(query)
-
-		if 'posts' in results:
-			posts = len(results['posts']['data'])
+		if 'posts' in new_results:
+			posts = len(new_results['posts']['data'])
 		else:
 			posts = 0
 		fb_rec['new_posts'] = posts
 
-		if 'videos' in results:
-			videos = len(results['videos']['data'])
+		if 'videos' in new_results:
+			videos = len(new_results['videos']['data'])
 		else:
 			videos = 0
 		fb_rec['new_videos'] = videos
 
-		metrics = [ 'page_impressions', 'page_impressions_unique', 'page_engaged_users', 'page_actions_post_reactions_like_total', 'page_fan_adds_unique', 'page_fan_removes_unique', 'page_views_total', 'page_video_views' ]
-		results = lyf.fb_insights_query(metrics, 'day', since=today)
-
-		for datum in results['data']:
+		for datum in insights['data']:
 			col = datum['name']
 			val = datum['values'][0]['value']
 			if col == 'page_impressions':
@@ -66,13 +64,14 @@ def main():
 			elif col == 'page_video_views':
 				fb_rec['video_views'] = val
 
-		db = psql.DB()
-		insert = db.upsert('f_facebook_daily', fb_rec, ['date_id'])
-		db.close()
+		with psql.session() as db:
+			insert = db.upsert('f_facebook_daily', fb_rec, ['date_id'])
 
 		logging.info('Merged %s row into f_facebook_daily.' % insert)
+		return(insert)
 	except Exception as err:
 		logging.error(err)
 
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
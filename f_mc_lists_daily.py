@@ -2,23 +2,20 @@
 # MailChimp integration
 
 import lyf, logging
-from lyf import psql
+from lyf import psql, mailchimp
 
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 def main():
 	try:
-		lists = lyf.get_mc_lists()
-		db = psql.DB()
-		i = 0
-		for list in lists:
-			# Fetch current totals
-			yesterday = db.query("select * from d_mc_lists where list_id = '%s'" % list.list_id)
+		lists = mailchimp.get_mc_lists()
+		today = date.today().strftime('%Y%m%d')
 
-			# Update snapshot fact
+		facts, dims = [], []
+		for list in lists:
+			# Snapshot fact
 			rec = {}
-			rec['date_id'] = date.today().strftime('%Y%m%d')
+			rec['date_id'] = today
 			rec['list_id'] = list.list_id
 			rec['open_rate'] = list.open_rate
 			rec['avg_sub_rate'] = list.avg_sub_rate
@@ -26,24 +23,25 @@ def main():
 			rec['total_unsubscribed'] = list.total_unsubscribed
 			rec['total_cleaned'] = list.total_cleaned
 			rec['total_campaigns'] = list.total_campaigns
-
-			if len(yesterday) > 0:
-				rec['members'] = list.total_members - yesterday[0]['total_members']
-				rec['unsubscribed'] = list.total_unsubscribed - yesterday[0]['total_unsubscribed']
-				rec['cleaned'] = list.total_cleaned - yesterday[0]['total_cleaned']
-			else:
-				rec['members'] = 0
-				rec['unsubscribed'] = 0
-				rec['cleaned'] = 0
-
-			db.upsert('f_mc_lists_daily', rec, ['date_id', 'list_id']) # Update snapshot fact
-			db.upsert('d_mc_lists', list.__dict__, ['list_id']) # Update dimension
-
-			i += 1
-		db.close()
-		logging.info('Merged %s rows into d_mc_lists and f_mc_lists_daily.' % i)
+			facts.append(rec)
+			dims.append(list.__dict__)
+
+		# Load both tables in one transaction, rolled back if either merge fails
+		with psql.session() as db:
+			# Derive changes from the current totals of all lists, before the dimension is updated
+			deltas = { 'members' : 'total_members', 'unsubscribed' : 'total_unsubscribed', 'cleaned' : 'total_cleaned' }
+			db.snapshot_deltas(facts, 'd_mc_lists', ['list_id'], deltas)
+
+			fact_merged = sum(db.upsert_many('f_mc_lists_daily', facts, ['date_id', 'list_id'], on_conflict=True)) # Update snapshot fact
+			dim_merged = sum(db.upsert_many('d_mc_lists', dims, ['list_id'], on_conflict=True)) # Update dimension
+			if fact_merged != len(facts) or dim_merged != len(dims):
+				raise Exception('Failed to merge MailChimp lists, rolled back.')
+
+		logging.info('Merged %s rows into d_mc_lists and f_mc_lists_daily.' % dim_merged)
+		return(dim_merged)
 	except Exception as err:
 		logging.error(err)
 
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
@@ -4,14 +4,13 @@
 import lyf, logging
 import os
 
-from lyf import psql
+from lyf import psql, twitter
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 def main():
 	try: 
 		twitter_rec = {}
-		api = lyf.twitter_api()
+		api = twitter.twitter_api()
 		me = api.me() # Details about me
 		
 		twitter_rec['date_id'] = date.today().strftime('%Y%m%d')
@@ -23,24 +22,16 @@ def main():
 		yesterday = yesterday.strftime('%Y%m%d')
 
 		# Check for yesterday's records to derive today's followers
-		db = psql.DB()
-		result = db.query("select * from f_twitter_daily where date_id = '%s'" % yesterday)
-		
-		if (len(result) > 0):
-			twitter_rec['followers'] = int(twitter_rec['total_followers']) - int(result[0]['total_followers'])
-			twitter_rec['following'] = int(twitter_rec['total_following']) - int(result[0]['total_following'])
-			twitter_rec['tweets'] = int(twitter_rec['total_tweets']) - int(result[0]['total_tweets'])
-		else:
-			twitter_rec['followers'] = 0
-			twitter_rec['following'] = 0
-			twitter_rec['tweets'] = 0
-		
-		insert = db.upsert('f_twitter_daily', twitter_rec, ['date_id'])
-		db.close()
+		with psql.session() as db:
+			deltas = { 'followers' : 'total_followers', 'following' : 'total_following', 'tweets' : 'total_tweets' }
+			db.snapshot_deltas([twitter_rec], 'f_twitter_daily', [], deltas, { 'date_id' : int(yesterday) })
+			insert = db.upsert('f_twitter_daily', twitter_rec, ['date_id'])
 		
 		logging.info('Merged %s row into f_twitter_daily.' % insert)
+		return(insert)
 	except Exception as err:
 		logging.error(err)
 		
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
@@ -4,15 +4,13 @@
 import lyf, logging
 import requests
 
-from lyf import psql
+from lyf import psql, youtube
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 def main():
 	try:
-		db = psql.DB()
-		videos = lyf.my_yt_videos()
-		inserts = 0
+		videos = youtube.my_yt_videos()
+		recs = []
 		
 		for video in videos:
 			rec = {}
@@ -24,30 +22,25 @@ def main():
 			rec['total_views'] = video.views
 			rec['total_likes'] = video.likes
 			rec['total_dislikes'] = video.dislikes
+			recs.append(rec)
 
-			# Check for yesterday's records to derive today's followers
+		with psql.session() as db:
+			# Derive today's figures from yesterday's snapshot of all videos
 			yesterday = date.today() - timedelta(days=1)
 			yesterday = int(yesterday.strftime('%Y%m%d'))
+			deltas = { 'views' : 'total_views', 'likes' : 'total_likes', 'dislikes' : 'total_dislikes' }
+			db.snapshot_deltas(recs, 'lyf.f_youtube_daily', ['video_id'], deltas, { 'date_id' : yesterday })
+
+			inserted, updated = db.upsert_many('f_youtube_daily', recs, ['date_id', 'video_id'])
+			inserts = inserted + updated
 
-			results = db.query("select * from lyf.f_youtube_daily where date_id = %s and video_id = %s", [yesterday, video.id])
-			
-			if (len(results) > 0):
-				rec['views'] = int(video.views) - int(results[0]['total_views'])
-				rec['likes'] = int(video.likes) - int(results[0]['total_likes'])
-				rec['dislikes'] = int(video.likes) - int(results[0]['total_likes'])
-			else:
-				rec['views'] = 0
-				rec['likes'] = 0
-				rec['dislikes'] = 0
-				
-			inserts += db.upsert('f_youtube_daily', rec, ['date_id', 'video_id'])
-		
-		db.close()
 		logging.info('Merged %s/%s rows into f_youtube_daily.' % (inserts, len(videos)))
+		return(inserts)
 	
 	except Exception as err:
 		logging.error(err)
 		
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
 
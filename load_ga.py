@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Load Google Analytics dimensions and fact table from one planned set of queries
+import lyf, logging
+import argparse
+import collections
+
+from lyf import psql, ga
+from datetime import date, timedelta, datetime	# Date time
+
+parser = argparse.ArgumentParser(description="Extract Google Analytics Dimensions and Facts")
+parser.add_argument("-f", "--full", action='store_true', default=False, help="Specifies full mode for extract as opposed to incremental.")
+parser.add_argument("-s", "--shard", default='month', choices=['day', 'week', 'month'], help="Date shard size for concurrent full mode extracts.")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent Google Analytics queries in full mode.")
+parser.add_argument("-c", "--cache-size", type=int, default=None, help="Maximum cached keys per dimension. Preloads whole dimensions by default.")
+
+args = parser.parse_args(None if __name__ == '__main__' else []) # Defaults when run by the job runner
+FULL_MODE = args.full
+SHARD = args.shard
+WORKERS = args.workers
+CACHE_SIZE = args.cache_size
+
+BLOG_TARGET = 'd_ga_page_blog'
+
+def main():
+	try:
+		dims = ga.get_ga_dims()
+		end_date = date.today().strftime('%Y-%m-%d')
+		if FULL_MODE:
+			start_date = lyf.get_config('ETL', 'Extract_Date')
+			shard = SHARD
+
+			with psql.session() as db:
+				psql.reload_countries(db)
+			logging.info('Reloaded d_country table.')
+		else:
+			# Extract from the earliest watermark of all the tables
+			with psql.session() as db:
+				tables = [table for table, ga_dims, columns, keys in dims] + [BLOG_TARGET, 'f_ga_daily']
+				start_date = min([psql.incremental_dates(db, table)[0] for table in tables])
+			shard = None
+
+		# Plan the fewest queries covering every dimension, the blog page details and the fact
+		targets = [ga.GA_Target(table, ga_dims) for table, ga_dims, columns, keys in dims]
+		targets.append(ga.GA_Target(BLOG_TARGET, ga.GA_BLOG_DIMENSIONS, filters=ga.GA_BLOG_FILTERS))
+		targets.append(ga.GA_Target('f_ga_daily', ga.GA_FACT_DIMENSIONS, ga.GA_FACT_METRICS, fact=True))
+
+		queries = ga.plan_ga_queries(targets)
+		logging.info('Extracting %s Google Analytics tables with %s queries.' % (len(targets), len(queries)))
+
+		with psql.session() as db:
+			loaders = [psql.GA_DimLoader(db, FULL_MODE, table, columns, keys) for table, ga_dims, columns, keys in dims]
+			if FULL_MODE:
+				db.truncate('lyf.f_ga_daily')
+			else:
+				db.delete_range('f_ga_daily', 'date_id', int(start_date.replace('-', '')), int(end_date.replace('-', '')))
+
+			# Load each page as it arrives. The dimensions projected from a page are merged before its facts resolve
+			# them, and the blog details, one row per post, are kept until every page has been merged
+			caches = psql.ga_fact_caches(db, CACHE_SIZE)
+			blog_rows = collections.OrderedDict()
+			success, total = 0, 0
+			for projected in ga.run_ga_plan(queries, start_date, end_date, shard, WORKERS):
+				for loader in loaders:
+					if loader.table in projected:
+						loader.merge(projected[loader.table])
+				for row in projected.get(BLOG_TARGET, []):
+					blog_rows[tuple(row)] = row
+				if 'f_ga_daily' in projected:
+					inserted, extracted = psql.load_ga_fact(db, [projected['f_ga_daily']], caches=caches)
+					success += inserted
+					total += extracted
+
+			summaries = [loader.finish(end_date) for loader in loaders]
+			failed = [summary['table'] for summary in summaries if summary['error'] is not None]
+			merged = sum([summary['merged'] for summary in summaries])
+			rows = sum([summary['rows'] for summary in summaries])
+			logging.info('Loaded %s/%s dimensions, merging %s/%s rows.' % (len(summaries) - len(failed), len(summaries), merged, rows))
+			if len(failed) > 0:
+				logging.error('Failed to load dimensions: %s' % ', '.join(failed))
+
+			updated_pages = psql.update_ga_blog(db, blog_rows.values())
+			if updated_pages > 0:
+				logging.info('Updated %s page entries with Blog and Author info.' % updated_pages)
+			logging.info('Inserted %s/%s fact records into f_ga_daily.' % (success, total))
+
+			# Facts whose dimensions failed to merge resolved to -1, so the watermarks stay put for the next run to
+			# load those dates again
+			if len(failed) > 0 or success != total:
+				return(None)
+			for table in [BLOG_TARGET, 'f_ga_daily']:
+				if not psql.set_watermark(db, table, end_date):
+					raise Exception('Failed to set the watermark of %s.' % table)
+		return(success)
+	except Exception as err:
+		logging.error(err)
+
+if __name__ == '__main__':
+	lyf.setup_logging()
+	main()
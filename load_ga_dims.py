@@ -6,80 +6,85 @@ import argparse
 import csv
 import os
 
-from lyf import psql
+from lyf import psql, ga
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent loads
 
 parser = argparse.ArgumentParser(description="Extract Google Analytics Dimensions")
 parser.add_argument("-f", "--full", action='store_true', default=False, help="Specifies full mode for extract as opposed to incremental.")
+parser.add_argument("-s", "--shard", default='month', choices=['day', 'week', 'month'], help="Date shard size for concurrent full mode extracts.")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent Google Analytics queries in full mode.")
+parser.add_argument("-p", "--parallel", type=int, default=4, help="Number of dimensions to load concurrently.")
 
-args = parser.parse_args()
+args = parser.parse_args(None if __name__ == '__main__' else []) # Defaults when run by the job runner
 FULL_MODE = args.full
+SHARD = args.shard
+WORKERS = args.workers
+PARALLEL = args.parallel
 
-def main():
-	file = os.path.join(lyf.SCRIPT_DIR, lyf.get_config('ETL', 'GA_Dims'))
-
-	# Read TSV file, looping through dimensions
-	i = 0
+# Load a single dimension on a worker thread
+def load_dim(dim):
+	table, ga_dims, columns, keys = dim
+	return(psql.load_ga_dim(FULL_MODE, table, ga_dims, columns, keys, SHARD, WORKERS))
 
+def main():
 	if FULL_MODE:
 		try:
-			db = psql.DB()
-
 			# Reload country table
-			countries_file = os.path.join(lyf.SCRIPT_DIR, 'data', 'countries.csv')
-			db.truncate('d_country')
-			db.reset_seq('d_country', 'country_id')
-			db.load_csv('d_country', countries_file)
-			db.close()
+			with psql.session() as db:
+				psql.reload_countries(db)
 			logging.info('Reloaded d_country table.')
 		except Exception as err:
 			logging.error(err)
 
-	with open(file, 'r') as f:
-		f = csv.reader(f, delimiter='\t')
-		for row in f:
-			if (i > 0):
-				if (len(row) > 0):
-					table = row[0]
-					ga_dims = row[1].split(',')
-					columns = row[2].split(',')
-					keys = row[3].split(',')
-
-					psql.load_ga_dim(FULL_MODE, table, ga_dims, columns, keys)
-			i += 1
+	# Read TSV file of dimensions
+	dims = ga.get_ga_dims()
 
-	# Post load processing
+	# Load independent dimensions concurrently
+	pool = ThreadPool(max(1, min(PARALLEL, len(dims))))
 	try:
-		db = psql.DB()
+		summaries = pool.map(load_dim, dims)
+	finally:
+		pool.terminate()
 
-		# Update the page table to apply any information about blog authors that can be found
-		end_date = date.today().strftime('%Y-%m-%d')
-		if FULL_MODE:
-			start_date = lyf.get_config('ETL', 'Extract_Date')
-		else:
-			start_date = end_date
+	failed = [summary['table'] for summary in summaries if summary['error'] is not None]
+	merged = sum([summary['merged'] for summary in summaries])
+	rows = sum([summary['rows'] for summary in summaries])
+	logging.info('Loaded %s/%s dimensions, merging %s/%s rows.' % (len(summaries) - len(failed), len(summaries), merged, rows))
+	if len(failed) > 0:
+		logging.error('Failed to load dimensions: %s' % ', '.join(failed))
 
-		service = lyf.google_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics.readonly'])
-		metrics = 'ga:sessions'
-		dims = 'ga:pageTitle,ga:contentGroup1,ga:contentGroup2'
-		filters = 'ga:contentGroup1==Blog;ga:contentGroup2!=(not set)'
-		results = lyf.ga_query(service, start_date, end_date, metrics, dims, filters)
-
-		updated_pages = 0
-		for row in results:
-			rec = { 'page_type' : row[1], 'author' : row[2] }
-			filter_rec = { 'page_title' : row[0] }
-			status = db.update('d_ga_page', rec, filter_rec)
-			if status == 1:
-				updated_pages += 1
-
-		if updated_pages > 0:
-			logging.info('Updated %s page entries with Blog and Author info.' % updated_pages)
-
-		db.close()
+	# Post load processing
+	updated_pages = 0
+	try:
+		with psql.session() as db:
+			# Update the page table to apply any information about blog authors that can be found
+			end_date = date.today().strftime('%Y-%m-%d')
+			if FULL_MODE:
+				start_date = lyf.get_config('ETL', 'Extract_Date')
+				shard = SHARD
+			else:
+				start_date, end_date = psql.incremental_dates(db, 'd_ga_page_blog')
+				shard = None
+
+			service = ga.google_api('analytics', 'v3', ga.GA_SCOPES)
+			metrics = 'ga:sessions'
+			dims = ','.join(ga.GA_BLOG_DIMENSIONS)
+			filters = ga.GA_BLOG_FILTERS
+
+			rows = ga.iter_ga_rows(service, start_date, end_date, metrics, dims, filters, shard, WORKERS)
+			updated_pages = psql.update_ga_blog(db, rows)
+			psql.set_watermark(db, 'd_ga_page_blog', end_date)
+
+			if updated_pages > 0:
+				logging.info('Updated %s page entries with Blog and Author info.' % updated_pages)
 	except Exception as err:
 		logging.error(err)
 
+	if len(failed) > 0:
+		return(None)
+	return(merged + updated_pages)
+
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
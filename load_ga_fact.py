@@ -6,71 +6,97 @@ import argparse
 import csv
 import os
 
-from lyf import psql
+from lyf import psql, ga
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
 
 parser = argparse.ArgumentParser(description="Extract Google Analytics Dimensions")
 parser.add_argument("-f", "--full", action='store_true', default=False, help="Specifies full mode for extract as opposed to incremental.")
+parser.add_argument("-s", "--shard", default='month', choices=['day', 'week', 'month'], help="Date shard size for concurrent full mode extracts.")
+parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent Google Analytics queries in full mode.")
+parser.add_argument("-r", "--resume", action='store_true', default=False, help="Resume a failed full mode load from its last completed date chunk.")
+parser.add_argument("--shadow", action='store_true', default=False, help="Load full mode into a shadow table, swapped in when complete.")
+parser.add_argument("-c", "--cache-size", type=int, default=None, help="Maximum cached keys per dimension. Preloads whole dimensions by default.")
 
-args = parser.parse_args()
+args = parser.parse_args(None if __name__ == '__main__' else []) # Defaults when run by the job runner
 FULL_MODE = args.full
+SHARD = args.shard
+WORKERS = args.workers
+CACHE_SIZE = args.cache_size
+RESUME = args.resume
+SHADOW = args.shadow
 
-def check_id(val, key, query, record, db):
-    if (val != '(not set)'):
-        query_results = db.query(query, [val])
-        if (len(query_results) == 0):
-            record[key] = -1
-        else:
-            record[key] = query_results[0][key]
-    else:
-        record[key] = -1
-    return(record)
+CHECKPOINT = 'f_ga_daily_backfill' # Watermark of the last chunk committed by a full mode load
+SHADOW_TABLE = 'f_ga_daily_shadow'
 
-def main():
-    try:
-        file = os.path.join(lyf.SCRIPT_DIR, lyf.get_config('ETL', 'GA_Dims'))
-        end_date = date.today().strftime('%Y-%m-%d')
+# Full mode load in date chunks of the shard size. Each chunk is committed with a checkpoint, so a failed load
+# can be resumed from the last completed chunk rather than starting again
+def backfill(db, metrics, dims):
+    end_date = date.today().strftime('%Y-%m-%d')
+    start_date = lyf.get_config('ETL', 'Extract_Date')
+    if SHADOW:
+        table = SHADOW_TABLE
+    else:
+        table = 'f_ga_daily'
 
-        db = psql.DB()
+    checkpoint = None
+    if RESUME:
+        checkpoint = psql.get_watermark(db, CHECKPOINT)
 
-        if FULL_MODE:
-            db.truncate('lyf.f_ga_daily')
-            start_date = lyf.get_config('ETL', 'Extract_Date')
+    if checkpoint is not None:
+        start_date = (checkpoint + timedelta(days=1)).strftime('%Y-%m-%d')
+        logging.info('Resuming full load of f_ga_daily from %s.' % start_date)
+    else:
+        if SHADOW:
+            psql.create_shadow(db, 'f_ga_daily', SHADOW_TABLE)
         else:
-            db.delete('f_ga_daily', { 'date_id' : date.today().strftime('%Y%m%d')})
-            start_date = end_date
+            db.truncate('lyf.f_ga_daily')
+        psql.clear_watermark(db, CHECKPOINT)
+        db.conn.commit()
+
+    caches = psql.ga_fact_caches(db, CACHE_SIZE)
+    success, total = 0, 0
+    for (chunk_start, chunk_end), rows in ga.iter_ga_chunks(start_date, end_date, metrics, dims, shard=SHARD, workers=WORKERS):
+        inserted, extracted = psql.load_ga_fact(db, [rows], table=table, caches=caches)
+        if inserted != extracted:
+            db.conn.rollback()
+            raise Exception('Failed to load %s to %s into f_ga_daily. Run with --resume to continue.' % (chunk_start, chunk_end))
+
+        if not psql.set_watermark(db, CHECKPOINT, chunk_end, until_yesterday=False):
+            raise Exception('Failed to checkpoint %s to %s into f_ga_daily. Run with --resume to continue.' % (chunk_start, chunk_end))
+        db.conn.commit()
+        success += inserted
+        total += extracted
 
-        service = lyf.google_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics.readonly'])
-        metrics = 'ga:sessions,ga:bounces,ga:bounceRate,ga:avgSessionDuration,ga:sessionDuration,ga:pageviews,ga:timeOnPage'
-        dims = 'ga:date,ga:cityId,ga:sourceMedium,ga:pageTitle,ga:longitude,ga:latitude,ga:userType'
-        results = lyf.ga_query(service, start_date, end_date, metrics, dims)
+    if SHADOW and not psql.swap_shadow(db, 'f_ga_daily', SHADOW_TABLE):
+        raise Exception('Failed to swap %s into f_ga_daily. Run with --resume --shadow to retry.' % SHADOW_TABLE)
+    psql.clear_watermark(db, CHECKPOINT)
+    if not psql.set_watermark(db, 'f_ga_daily', end_date):
+        raise Exception('Failed to set the watermark of f_ga_daily. Run with --resume to retry.')
+    return(success, total)
+
+def main():
+    try:
+        with psql.session() as db:
+            metrics = ','.join(ga.GA_FACT_METRICS)
+            dims = ','.join(ga.GA_FACT_DIMENSIONS)
 
-        success = 0
-        for row in results:
-            rec = {}
-            rec['date_id'] = row[0]
-            rec = check_id(row[1], 'geo_id', 'select geo_id from lyf.d_ga_geo where city_id = %s;', rec, db)
-            rec = check_id(row[2], 'source_id', 'select source_id from lyf.d_ga_source where source_medium = %s;', rec, db)
-            rec = check_id(row[3], 'page_id', 'select page_id from lyf.d_ga_page where page_title = %s;', rec, db)
-            rec['longitude'] = row[4]
-            rec['latitude'] = row[5]
-            rec['user_type'] = row[6]
-            rec['sessions'] = row[7]
-            rec['bounces'] = row[8]
-            rec['bounce_rate'] = row[9]
-            rec['avg_session_duration'] = row[10]
-            rec['session_duration'] = row[11]
-            rec['page_views'] = row[12]
-            rec['time_on_page'] = row[13]
+            if FULL_MODE:
+                success, total = backfill(db, metrics, dims)
+            else:
+                # Replace the dates since the last complete day loaded
+                start_date, end_date = psql.incremental_dates(db, 'f_ga_daily')
+                db.delete_range('f_ga_daily', 'date_id', int(start_date.replace('-', '')), int(end_date.replace('-', '')))
 
-            status = db.insert('f_ga_daily', rec)
-            if (status == 1):
-                success += 1
+                service = ga.google_api('analytics', 'v3', ga.GA_SCOPES)
+                pages = ga.iter_ga_results(service, start_date, end_date, metrics, dims)
+                success, total = psql.load_ga_fact(db, pages, CACHE_SIZE)
+                if success == total:
+                    psql.set_watermark(db, 'f_ga_daily', end_date)
 
-        logging.info('Inserted %s/%s fact records into f_ga_daily.' % (success, len(results)))
-        db.close()
+            logging.info('Inserted %s/%s fact records into f_ga_daily.' % (success, total))
+            return(success)
     except Exception as err:
 		logging.error(err)
 if __name__ == '__main__':
+	lyf.setup_logging()
 	main()
@@ -1,19 +1,23 @@
 #! /usr/bin/env python
 # LYF data integration function library
 
+# Sources are in their own modules (lyf.ga, lyf.youtube, lyf.facebook, lyf.twitter and lyf.mailchimp), which import
+# their client libraries on first use, so that scripts only pay for the libraries they need
+
 import sys, os, logging
 import requests
-import argparse
-import httplib2
-import tweepy
-import re
+import threading
+import Queue
+import json
+import time
+import random
+import urlparse
+import email.utils
+import shutil
+import tempfile
 
 from ConfigParser import ConfigParser	#	Used for reading the config file
-from apiclient.discovery import build	# Builds Google API service
-from oauth2client.service_account import ServiceAccountCredentials	# Google authenticator
-from oauth2client import client, file, tools	# Functions for OAuth2
-from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
+from lyf import trace	# Stage timings and counts
 
 global SCRIPT_DIR
 SCRIPT_DIR = os.path.abspath(os.path.dirname(sys.argv[0]))
@@ -23,361 +27,323 @@ CONFIG = os.path.join(SCRIPT_DIR, 'config.ini')
 global LOG_FORMAT, LOG_FILE
 LOG_FORMAT = '%(levelname)s: %(asctime)s [%(filename)s (%(funcName)s - Line %(lineno)s)]: %(message)s'
 LOG_FILE = os.path.join(SCRIPT_DIR, 'logs', 'out.log')
-logging.basicConfig(filename=LOG_FILE,level=logging.INFO, format=LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
-
-logging.getLogger().addHandler(logging.StreamHandler()) # Print to stderr
-
-# Suppress sub module messages
-logging.getLogger("requests").setLevel(logging.CRITICAL)
-logging.getLogger("tweepy").setLevel(logging.CRITICAL)
-logging.getLogger("discovery").setLevel(logging.CRITICAL)
-logging.getLogger("googleapiclient").setLevel(logging.CRITICAL)
-logging.getLogger("oauth2client").setLevel(logging.CRITICAL)
-
-# Define modules in the package
-__all__ = ["sql"]
-
-# Class for youtube videos
-class YT_Video():
-	def __init__(self, id, name, publish_date, channel, views=0, likes=0, dislikes=0): # Initialiser
-		self.id = id
-		self.name = name
-		self.publish_date = parse(publish_date)
-		self.channel = channel
-		self.views = int(views)
-		self.likes = int(likes)
-		self.dislikes = int(dislikes)
-
-# Class for MailChimp subscriber lists
-class MC_List():
-	def __init__(self, id, name, created_date, subscribe_url='', total_members=0, \
-		total_unsubscribed=0, total_cleaned=0, total_campaigns=0, open_rate=0, click_rate=0, \
-		avg_sub_rate=0, last_campaign=None, last_subscriber=None): # Initialiser
-		self.list_id = id
-		self.name = name
-		self.created_date = parse(created_date)
-		self.subscribe_url = subscribe_url
-		self.total_members = int(total_members)
-		self.total_unsubscribed = int(total_unsubscribed)
-		self.total_cleaned = int(total_cleaned)
-		self.total_campaigns = int(total_campaigns)
-		self.open_rate = float(open_rate)
-		self.avg_sub_rate = float(avg_sub_rate)
-		self.last_campaign = parse(last_campaign)
-		self.last_subscriber = parse(last_subscriber)
-
-class MC_Campaign():
-	def __init__(self, id, name, subject, created, emails_sent, open_rate, click_rate, subscriber_clicks, clicks, opens, \
-	 	unique_opens):
-		self.campaign_id = id
-		self.name = name
-		self.subject = subject
-		self.emails_sent = emails_sent
-		self.created_date = created
-		self.emails_sent = emails_sent
-		self.open_rate = open_rate
-		self.click_rate = click_rate
-		self.subscriber_clicks = subscriber_clicks
-		self.clicks = clicks
-		self.opens = opens
-
-# Gets a configuration value from a section and parameter name
-def get_config(section, param):
-	parser = ConfigParser()
-	parser.read(CONFIG)
-	out = parser.get(section, param).replace('\\','')
-	return out
-
-# Sets a configuration value in a section
-def write_config(section, param, value):
-	parser = ConfigParser()
-	parser = ConfigParser()
-	parser.read(CONFIG)
-	parser.set(section, param, value)
-	cfgfile = open(CONFIG,'w')
-	parser.write(cfgfile)
-	cfgfile.close()
-
-# Gets an authenticated service for a given Google API and versioin
-def google_api(api, version, scopes):
-	key_file = os.path.join(SCRIPT_DIR, get_config('GOOGLE_ANALYTICS','Key_File'))
-	credentials = ServiceAccountCredentials.from_json_keyfile_name(key_file, scopes=scopes)
-	http = credentials.authorize(httplib2.Http())
-	service = build(api, version, http=http) # Build the service object.
-	return service
-
-# Connects to Twitter API and returns the service object
-def twitter_api():
-	consumer_key = get_config('TWITTER', 'Consumer_Key')
-	consumer_secret = get_config('TWITTER', 'Consumer_Secret')
-	access_token = get_config('TWITTER', 'Access_Token')
-	access_token_secret = get_config('TWITTER', 'Access_Token_Secret')
-
-	auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-	auth.set_access_token(access_token, access_token_secret)
-	api = tweepy.API(auth)
-	return(api)
-
-# Use the API service object to get the first profile id
-def get_ga_profile(service):
-	# Get a list of all Google Analytics accounts for this user
-	accounts = service.management().accounts().list().execute()
-
-	if accounts.get('items'):
-		# Get the first Google Analytics account.
-		account = accounts.get('items')[0].get('id')
-
-	# Get a list of all the properties for the first account.
-	properties = service.management().webproperties().list(accountId=account).execute()
-
-	if properties.get('items'):
-		# Get the first property id.
-		property = properties.get('items')[0].get('id')
-
-	# Get a list of all views (profiles) for the first property.
-	profiles = service.management().profiles().list(accountId=account, webPropertyId=property).execute()
-
-	if profiles.get('items'):
-		# return the first view (profile) id.
-		return profiles.get('items')[0].get('id')
-
-	return None
-
-# Executes a subquery using the FB API, appending the results of multiple pages into the main array
-def fb_sub_query(orig_data, curr_data):
-	r = requests.get(curr_data['paging']['next'])
-	r.raise_for_status()
-	sub_results = r.json()
-	for datum in sub_results['data']:
-		orig_data['data'].append(datum)
-
-	if 'paging' in sub_results:
-		if 'next' in sub_results['paging']:
-			fb_sub_query(orig_data, sub_results)
-
-# Query Facebook Graph API to get page information
-def fb_query(fields, token=False):
-        if not token:
-		token = get_config('FACEBOOK', 'Access_Token')
-	
-        graph_url = 'https://graph.facebook.com/v' + get_config('FACEBOOK', 'API_Version')
-	page_id = 'me' # Access token is for own page
-        url = '%s/%s?access_token=%s&fields=%s' % (graph_url, page_id, token, fields)
-        
-        r = requests.get(url)
-	r.raise_for_status()
-
-	results = r.json()
 
-	for prop in results:
-		if isinstance(results[prop], dict):
-			if 'paging' in results[prop]:
-				if 'next' in results[prop]['paging']:
-					fb_sub_query(results[prop], results[prop])
+# Concurrent requests allowed to each API host across all threads. Other hosts are limited to HTTP Max_Per_Host
+global HOST_LIMITS
+HOST_LIMITS = { 'www.googleapis.com' : 10, 'graph.facebook.com' : 4, 'api.mailchimp.com' : 4 }
+HOST_SEMAPHORES = {}
+HOST_LOCK = threading.Lock()
 
-	return(results)
+# Sustained requests per second and burst size for each API host. Other hosts use HTTP Max_Rate with the same burst
+global API_RATES, RETRY_STATUSES, RETRY_LIMIT, BACKOFF_MAX
+API_RATES = { 'www.googleapis.com' : (10, 10), 'graph.facebook.com' : (2, 10), 'api.mailchimp.com' : (10, 10) }
+RETRY_STATUSES = [429, 500, 502, 503, 504] # Throttled or transient server errors
+RETRY_LIMIT = 5
+BACKOFF_MAX = 64 # Longest wait in seconds between attempts, unless the server asks for longer
 
-# Insights queries require read_insights privilege
-def fb_insights_query(metrics, period=False, since=False, until=False, token=False):
-	metrics = ','.join(metrics)
+# Graph API throttling: error codes for rate limited calls, and the usage percentage at which to stop sending
+global FB_THROTTLE_CODES, FB_USAGE_LIMIT, FB_USAGE_PAUSE
+FB_THROTTLE_CODES = [4, 17, 32, 613]
+FB_USAGE_LIMIT = 90
+FB_USAGE_PAUSE = 300 # Seconds to stop sending when the limit is reached and no regain time is given
 
-	if not token:
-		token = get_config('FACEBOOK', 'Access_Token')
+API_BUCKETS = {}
+API_STATS = {}
 
-	graph_url = 'https://graph.facebook.com/v' + get_config('FACEBOOK', 'API_Version')
-	page_id = 'me' # Access token is for own page
+THREAD_DATA = threading.local()
 
-	if period:
-		if not period in ['day', 'week', 'month', 'days_28', 'lifetime']:
-			period = False
-
-	if period:
-		url = '%s/%s/insights/%s?access_token=%s&period=%s' % (graph_url, page_id, metrics, token, period)
-		if since:
-			url += '&since=%s' % since
-		if until:
-			url += '&until=%s' % until
-		r = requests.get(url)
-	else:
-		r = requests.get('%s/%s/insights/%s?access_token=%s' % (graph_url, page_id, metrics, token))
+# Define modules in the package
+__all__ = ["sql"]
 
-	r.raise_for_status()
-	results = r.json()
-
-	for prop in results:
-		if isinstance(results[prop], dict):
-			if 'paging' in results[prop]:
-				if 'next' in results[prop]['paging']:
-					fb_sub_query(results[prop], results[prop])
-
-	return(results)
-
-# Renew Facebook access token
-def renew_fb_token():
-	url = 'https://graph.facebook.com/v' + get_config('FACEBOOK', 'API_Version')
-	url += '/oauth/access_token?grant_type=fb_exchange_token&client_id=%s' % get_config('FACEBOOK', 'App_ID')
-	url += '&client_secret=%s&Reset&fb_exchange_token=%s' % (get_config('FACEBOOK', 'App_Secret'), get_config('FACEBOOK', 'Access_Token'))
-
-	r = requests.get(url)
-	new_token = r.json()['access_token']
-	perm_token = fb_query('access_token', new_token)['access_token']
-
-	write_config('FACEBOOK', 'Access_Token', perm_token)
-	logging.info('New Facebook access token written to %s.' % CONFIG)
-
-# Query Google Analytics API to retrieve some data
-def ga_query(service, start_date, end_date, metrics, dimensions=None, filters=None):
-	def fetch_results(service, start_date, end_date, metrics, dimensions, results=[], start_index=1):
-		if dimensions is None:
-			if filters is None:
-				new_results = service.data().ga().get(
-					ids='ga:' + get_config('GOOGLE_ANALYTICS', 'Profile'),
-					start_date=start_date,
-					end_date=end_date,
-					max_results=10000,
-					start_index=start_index,
-					metrics=metrics).execute()
-			else:
-				new_results = service.data().ga().get(
-					ids='ga:' + get_config('GOOGLE_ANALYTICS', 'Profile'),
-					start_date=start_date,
-					end_date=end_date,
-					max_results=10000,
-					start_index=start_index,
-					metrics=metrics,
-					filters=filters).execute()
-		else:
-			if filters is None:
-				new_results = service.data().ga().get(
-					ids='ga:' + get_config('GOOGLE_ANALYTICS', 'Profile'),
-					start_date=start_date,
-					end_date=end_date,
-					metrics=metrics,
-					max_results=10000,
-					start_index=start_index,
-					dimensions=dimensions).execute()
-			else:
-				new_results = service.data().ga().get(
-					ids='ga:' + get_config('GOOGLE_ANALYTICS', 'Profile'),
-					start_date=start_date,
-					end_date=end_date,
-					metrics=metrics,
-					max_results=10000,
-					start_index=start_index,
-					dimensions=dimensions,
-					filters=filters).execute()
-
-		if new_results.has_key('rows'):
-			results = results + new_results['rows']
-			new_start_index = int(new_results['query']['start-index']) + len(new_results['rows'])
-			if (new_results['totalResults'] >= new_start_index):
-				results = fetch_results(service, start_date, end_date, metrics, dimensions, results, new_start_index)
-				return(results)
-			else:
-				return(results)
-		else:
-			results = results + []
-
-	results = fetch_results(service, start_date, end_date, metrics, dimensions)
-	if (results is None):
-		results = []
-	return(results)
-
-# Get all youtube videos belonging to the configured YouTube channel
-def my_yt_videos():
-	youtube = google_api('youtube', 'v3', ['https://www.googleapis.com/auth/youtube'])
-	max_results = 50
-
-	def video_search(youtube, next_page, videos=[]):
-		if (next_page == False):
-			results = youtube.search().list(
-				type="video",
-				channelId=get_config('GOOGLE_ANALYTICS', 'YouTube_Channel'),
-				part="snippet",
-				maxResults=max_results
-			).execute()
-		else:
-			results = youtube.search().list(
-				type="video",
-				channelId=get_config('GOOGLE_ANALYTICS', 'YouTube_Channel'),
-				part="snippet",
-				pageToken=next_page,
-				maxResults=max_results
-			).execute()
-
-		video_ids = []
-		for item in results['items']:
-			video_ids.append(item['id']['videoId'])
-		video_ids = ','.join(video_ids)
-
-		video_response = youtube.videos().list(
-			id=video_ids,
-    		part='snippet, statistics'
-		).execute()
-
-		for item in video_response.get('items', []):
-			id = item['id']
-			title = item['snippet']['title']
-			publish_date = item['snippet']['publishedAt']
-			channel = item['snippet']['channelTitle']
-			views = item['statistics']['viewCount']
-			likes = item['statistics']['likeCount']
-			dislikes = item['statistics']['dislikeCount']
-			video = YT_Video(id, title, publish_date, channel, views, likes, dislikes)
-			videos.append(video)
-
-		if (results.has_key('nextPageToken')):
-			videos = video_search(youtube, results['nextPageToken'], videos)
-			return(videos)
+# Log to the log file and stderr. Scripts call this when they are run rather than on import, and only the first call
+# has any effect
+def setup_logging():
+	root = logging.getLogger()
+	if len(root.handlers) > 0:
+		return
+
+	logging.basicConfig(filename=LOG_FILE,level=logging.INFO, format=LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+	root.addHandler(logging.StreamHandler()) # Print to stderr
+
+	# Suppress sub module messages
+	logging.getLogger("requests").setLevel(logging.CRITICAL)
+	logging.getLogger("tweepy").setLevel(logging.CRITICAL)
+	logging.getLogger("discovery").setLevel(logging.CRITICAL)
+	logging.getLogger("googleapiclient").setLevel(logging.CRITICAL)
+	logging.getLogger("oauth2client").setLevel(logging.CRITICAL)
+
+# Parsed configuration, cached until config.ini is modified
+CONFIG_CACHE = { 'mtime' : None, 'parser' : None, 'values' : {} }
+CONFIG_LOCK = threading.RLock()
+
+# Gets the parsed configuration file, only re-reading it if its modification time has changed
+def load_config():
+	try:
+		mtime = os.path.getmtime(CONFIG)
+	except OSError:
+		mtime = None
+
+	with CONFIG_LOCK:
+		if CONFIG_CACHE['parser'] is None or CONFIG_CACHE['mtime'] != mtime:
+			parser = ConfigParser()
+			parser.read(CONFIG)
+			CONFIG_CACHE['parser'] = parser
+			CONFIG_CACHE['mtime'] = mtime
+			CONFIG_CACHE['values'] = {}
+		return(CONFIG_CACHE['parser'], CONFIG_CACHE['values'])
+
+# Gets a configuration value from a section and parameter name, falling back to a default if the parameter is not set
+def get_config(section, param, default=None):
+	parser, values = load_config()
+	if (section, param) not in values:
+		if default is not None and not parser.has_option(section, param):
+			return default
+		values[(section, param)] = parser.get(section, param).replace('\\','')
+	return values[(section, param)]
+
+# Sets a configuration value in a section. The file is replaced atomically through a temporary file of its own,
+# keeping the mode of the original as it holds the API secrets, and the cache updated in place
+def write_config(section, param, value):
+	with CONFIG_LOCK:
+		parser = ConfigParser()
+		parser.read(CONFIG)
+		parser.set(section, param, value)
+
+		fd, tmp_file = tempfile.mkstemp(prefix='.%s.' % os.path.basename(CONFIG), dir=os.path.dirname(CONFIG))
+		try:
+			with os.fdopen(fd, 'w') as cfgfile:
+				parser.write(cfgfile)
+			if os.path.exists(CONFIG):
+				shutil.copymode(CONFIG, tmp_file)
+			os.rename(tmp_file, CONFIG)
+		except:
+			os.remove(tmp_file)
+			raise
+
+		CONFIG_CACHE['parser'] = parser
+		CONFIG_CACHE['mtime'] = os.path.getmtime(CONFIG)
+		CONFIG_CACHE['values'] = {}
+
+# Gets a keep-alive HTTP session for the current thread, so repeated calls to an API reuse their connections.
+# Sessions record or replay requests if a replay mode is configured
+def http_session():
+	if not hasattr(THREAD_DATA, 'http_session'):
+		session = None
+		if get_config('REPLAY', 'Mode', '') != '':
+			from lyf import replay	# Record and replay API traffic
+			session = replay.replay_session()
+		THREAD_DATA.http_session = session or requests.Session()
+	return(THREAD_DATA.http_session)
+
+# Class for a token bucket, limiting the rate of requests to an API shared by all threads
+class TokenBucket():
+	# Initialiser
+	def __init__(self, rate, capacity):
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated = time.time()
+		self.paused_until = 0
+		self.lock = threading.Lock()
+
+	# Take a token, returning the number of seconds the caller must wait before sending its request.
+	# Tokens are reserved in advance, so concurrent callers queue up behind each other
+	def take(self):
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+			return(max(0, -self.tokens / self.rate, self.paused_until - now))
+
+	# Stop all callers sending for a number of seconds, e.g. when the server asks us to retry later
+	def pause(self, seconds):
+		with self.lock:
+			self.paused_until = max(self.paused_until, time.time() + seconds)
+
+# Gets the host used to group the limits for a URL. MailChimp data centres share a single limit
+def api_host(url):
+	host = urlparse.urlparse(url).hostname
+	if host.endswith('.api.mailchimp.com'):
+		host = 'api.mailchimp.com'
+	return(host)
+
+# Gets the token bucket limiting the rate of requests to a host
+def api_bucket(host):
+	with HOST_LOCK:
+		if host not in API_BUCKETS:
+			rate, burst = API_RATES.get(host) or (float(get_config('HTTP', 'Max_Rate', 10)), 10)
+			API_BUCKETS[host] = TokenBucket(rate, burst)
+		return(API_BUCKETS[host])
+
+# Add to the request metrics for a host
+def api_record(host, **counts):
+	with HOST_LOCK:
+		stats = API_STATS.setdefault(host, { 'requests' : 0, 'retries' : 0, 'wait_seconds' : 0 })
+		for stat, count in counts.items():
+			stats[stat] += count
+
+# Gets the request, retry and wait metrics for each host since the process started
+def api_stats():
+	with HOST_LOCK:
+		return(dict([(host, dict(stats)) for host, stats in API_STATS.items()]))
+
+# Parse a Retry-After header, given either as seconds or as a date. Returns the seconds to wait, or 0 if not given
+def retry_after(value):
+	if value is None:
+		return(0)
+	try:
+		return(max(0, float(value)))
+	except ValueError:
+		parsed = email.utils.parsedate_tz(value)
+		if parsed is None:
+			return(0)
+		return(max(0, email.utils.mktime_tz(parsed) - time.time()))
+
+# Send an API request through the scheduler for its host, waiting for a token and a free connection slot.
+# send makes a single attempt and check decides whether its response or error is worth retrying, returning None if
+# not or the seconds the server asked to wait. Retries back off exponentially with jitter. When attempts run out the
+# last response is returned or the last error raised
+def api_call(host, send, check, retries=RETRY_LIMIT):
+	bucket = api_bucket(host)
+	for attempt in xrange(retries + 1):
+		wait = bucket.take()
+		if wait > 0:
+			api_record(host, wait_seconds=wait)
+			time.sleep(wait)
+
+		error = None
+		with trace.span('http', host) as span:
+			trace.add(requests=1)
+			try:
+				with host_semaphore(host):
+					result = send()
+				delay = check(host, result, None)
+			except Exception as err:
+				error, result = sys.exc_info(), None
+				delay = check(host, None, err)
+				span.add(errors=1)
+		api_record(host, requests=1)
+
+		if delay is None or attempt == retries:
+			if error is not None:
+				raise error[0], error[1], error[2]
+			return(result)
+
+		# Everyone waits for the server's retry time, but only this caller backs off
+		api_record(host, retries=1)
+		if delay > 0:
+			bucket.pause(delay)
+		delay = max(delay, min(BACKOFF_MAX, 2 ** attempt) + random.random())
+		api_record(host, wait_seconds=delay)
+		time.sleep(delay)
+
+# Gets the highest Graph API usage percentage reported in the response headers, and the seconds until access is
+# regained if Facebook gives one
+def fb_usage(headers):
+	usage, regain = 0, 0
+	for header in ['X-App-Usage', 'X-Page-Usage', 'X-Ad-Account-Usage', 'X-Business-Use-Case-Usage']:
+		if header not in headers:
+			continue
+		try:
+			values = json.loads(headers[header])
+		except ValueError:
+			continue
+
+		# Business use case usage is a list of usage objects for each business
+		if header == 'X-Business-Use-Case-Usage':
+			values = [value for business in values.values() for value in business]
 		else:
-			return(videos)
-
-	videos = video_search(youtube, False)
-	return(videos)
-
-# Get MailChimp subscriber lists
-def get_mc_lists(query_string=False):
-	user = get_config('MAILCHIMP', 'User')
-	api_key = get_config('MAILCHIMP', 'API_Key')
-	dc = re.search('-(.*?)$', api_key).group(1)
-	if not query_string:
-		url = 'https://%s.api.mailchimp.com/3.0/lists' % dc
-	else:
-		url = 'https://%s.api.mailchimp.com/3.0/lists?%s' % (dc, query_string)
-
-	r = requests.get(url, auth=(user, api_key))
+			values = [values]
+		for value in values:
+			for key in ['call_count', 'total_cputime', 'total_time', 'acc_id_util_pct']:
+				usage = max(usage, value.get(key, 0))
+			regain = max(regain, value.get('estimated_time_to_regain_access', 0) * 60)
+	return(usage, regain)
+
+# Whether an HTTP request should be retried: connection failures, throttling and transient server errors.
+# Graph API usage headers close to the limit pause further requests to Facebook
+def http_retry_delay(host, r, err):
+	if err is not None:
+		return(0 if isinstance(err, (requests.ConnectionError, requests.Timeout)) else None)
+
+	usage, regain = fb_usage(r.headers)
+	if usage >= FB_USAGE_LIMIT:
+		logging.warning('Graph API usage at %s%%, pausing requests to %s.' % (usage, host))
+		api_bucket(host).pause(regain or FB_USAGE_PAUSE)
+
+	if r.status_code in RETRY_STATUSES:
+		return(retry_after(r.headers.get('Retry-After')))
+	if r.status_code in [400, 403] and host == 'graph.facebook.com':
+		try:
+			code = r.json()['error']['code']
+		except Exception:
+			code = None
+		if code in FB_THROTTLE_CODES:
+			return(regain)
+	return(None)
+
+# Gets the semaphore bounding concurrent requests to a host
+def host_semaphore(host):
+	with HOST_LOCK:
+		if host not in HOST_SEMAPHORES:
+			limit = HOST_LIMITS.get(host) or int(get_config('HTTP', 'Max_Per_Host', 4))
+			HOST_SEMAPHORES[host] = threading.BoundedSemaphore(limit)
+		return(HOST_SEMAPHORES[host])
+
+# Send a request with the current thread's session through the request scheduler, retrying throttled requests and
+# transient failures
+def http_request(method, url, **kwargs):
+	def send():
+		r = http_session().request(method, url, **kwargs)
+		trace.add(bytes=len(r.content))
+		return(r)
+
+	r = api_call(api_host(url), send, http_retry_delay)
 	r.raise_for_status()
-	results = r.json()
-
-	lists = []
-	for list in results['lists']:
-		new_list = MC_List(list['id'], list['name'], list['date_created'], list['subscribe_url_short'], \
-			list['stats']['member_count'], list['stats']['unsubscribe_count'], list['stats']['cleaned_count'], \
-			list['stats']['campaign_count'], list['stats']['open_rate'], list['stats']['click_rate'], \
-			list['stats']['avg_sub_rate'], list['stats']['campaign_last_sent'], list['stats']['last_sub_date'] \
-		)
-		lists.append(new_list)
-
-	return(lists)
-
-# Get MailChimp campaigns
-def get_mc_campaigns():
-	user = get_config('MAILCHIMP', 'User')
-	api_key = get_config('MAILCHIMP', 'API_Key')
-	dc = re.search('-(.*?)$', api_key).group(1)
-	url = 'https://%s.api.mailchimp.com/3.0/campaigns' % dc
-
-	r = requests.get(url, auth=(user, api_key))
-	r.raise_for_status()
-	results = r.json()
-
-	campaigns = []
-	for campaign in results['campaigns']:
-		new_campaign = MC_Campaign(campaign['id'], campaign['settings']['title'], campaign['settings']['subject_line'], \
-			campaign['create_time'], campaign['emails_sent'], campaign['report_summary']['open_rate'], \
-			campaign['report_summary']['click_rate'], campaign['report_summary']['subscriber_clicks'], \
-			campaign['report_summary']['clicks'], campaign['report_summary']['opens'], \
-		 	campaign['report_summary']['unique_opens'])
-		campaigns.append(new_campaign)
-
-	return(campaigns)
+	return(r)
+
+# Consume an iterable on a background thread, keeping up to size items ready ahead of the caller. If the caller
+# stops early the producer stops too, closing the iterable so that it releases its connection
+def prefetch(iterable, size=1):
+	buffer = Queue.Queue(maxsize=size)
+	stop = threading.Event()
+	done = object()
+
+	# Put an item in the buffer, waiting for room until the caller stops. Returns whether the item was put
+	def put(item):
+		while not stop.is_set():
+			try:
+				buffer.put(item, timeout=0.5)
+				return(True)
+			except Queue.Full:
+				pass
+		return(False)
+
+	def producer():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return
+			put((done, None))
+		except Exception:
+			put((None, sys.exc_info())) # Raised by the caller with the producer's traceback
+		finally:
+			if hasattr(iterable, 'close'):
+				iterable.close()
+
+	thread = threading.Thread(target=producer)
+	thread.daemon = True
+	thread.start()
+
+	try:
+		while True:
+			item, exc_info = buffer.get()
+			if exc_info is not None:
+				raise exc_info[0], exc_info[1], exc_info[2]
+			if item is done:
+				break
+			yield item
+	finally:
+		stop.set()
+
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# Synthetic data and measurements for the ETL benchmarks
+
+import lyf, logging
+import os
+import json
+import time
+import resource
+
+from datetime import date, timedelta, datetime	# Date time
+
+# Distinct values of the GA dimensions relative to the number of fact rows, roughly as in production
+global GA_SOURCE_RATIO, GA_PAGE_RATIO, GA_GEO_RATIO, GA_MEDIA, BASELINE_FILE
+GA_SOURCE_RATIO = 0.01
+GA_PAGE_RATIO = 0.05
+GA_GEO_RATIO = 0.02
+GA_MEDIA = ['organic', 'referral', 'social', 'email', 'cpc', '(none)']
+BASELINE_FILE = os.path.join(lyf.SCRIPT_DIR, 'benchmarks', 'baseline.json')
+
+# Deterministic number for a row and column, so every run loads identical data
+def number(i, j, high=1000):
+	return((i * 7919 + j * 104729) % high)
+
+# Number of distinct dimension values for a number of fact rows
+def dim_size(rows, ratio):
+	return(max(1, int(rows * ratio)))
+
+# Rows for d_ga_source with surrogate keys from 1, so the table's sequence is not used
+def ga_source_rows(n):
+	for i in xrange(n):
+		medium = GA_MEDIA[i % len(GA_MEDIA)]
+		yield { 'source_id' : i + 1, 'source_medium' : ga_source_medium(i), \
+			'source' : 'source%s.com' % i, 'medium' : medium, 'social_network' : '(not set)' }
+
+# Rows for d_ga_page
+def ga_page_rows(n):
+	for i in xrange(n):
+		yield { 'page_id' : i + 1, 'page_title' : 'Page %s | Lightyear Foundation' % i, 'page_type' : None, 'author' : None }
+
+# Rows for d_ga_geo
+def ga_geo_rows(n):
+	for i in xrange(n):
+		yield { 'geo_id' : i + 1, 'continent' : 'Europe', 'sub_continent' : 'Northern Europe', 'country' : 'United Kingdom', \
+			'country_code' : 'GB', 'region' : 'Region %s' % (i % 100), 'city_id' : str(1000000 + i), 'city' : 'City %s' % i }
+
+# Source / medium value of a generated source
+def ga_source_medium(i):
+	return('source%s.com / %s' % (i, GA_MEDIA[i % len(GA_MEDIA)]))
+
+# Raw Google Analytics rows for the fact dimensions and metrics, as returned by the API, spread over a year of dates
+# and referring to the dimension rows generated for the same number of fact rows
+def ga_fact_results(n):
+	sources = dim_size(n, GA_SOURCE_RATIO)
+	pages = dim_size(n, GA_PAGE_RATIO)
+	geos = dim_size(n, GA_GEO_RATIO)
+	start = date(2016, 1, 1)
+	for i in xrange(n):
+		day = (start + timedelta(days=i * 365 // n)).strftime('%Y%m%d')
+		sessions = number(i, 0, 50) + 1
+		bounces = number(i, 1, sessions + 1)
+		duration = float(number(i, 2, 3600))
+		yield [day, str(1000000 + number(i, 3, geos)), ga_source_medium(number(i, 4, sources)), \
+			'Page %s | Lightyear Foundation' % number(i, 5, pages), '%.4f' % (number(i, 6, 360000) / 1000.0 - 180), \
+			'%.4f' % (number(i, 7, 180000) / 1000.0 - 90), ['New Visitor', 'Returning Visitor'][i % 2], str(sessions), \
+			str(bounces), str(100.0 * bounces / sessions), str(duration / sessions), str(duration), \
+			str(number(i, 8, 20) + 1), str(float(number(i, 9, 600)))]
+
+# Rows for f_ga_daily with surrogate keys already resolved
+def ga_fact_rows(n):
+	for i, row in enumerate(ga_fact_results(n)):
+		yield { 'date_id' : row[0], 'geo_id' : number(i, 3, dim_size(n, GA_GEO_RATIO)) + 1, \
+			'source_id' : number(i, 4, dim_size(n, GA_SOURCE_RATIO)) + 1, 'page_id' : number(i, 5, dim_size(n, GA_PAGE_RATIO)) + 1, \
+			'longitude' : row[4], 'latitude' : row[5], 'user_type' : row[6], 'sessions' : row[7], 'bounces' : row[8], \
+			'bounce_rate' : row[9], 'avg_session_duration' : row[10], 'session_duration' : row[11], 'page_views' : row[12], \
+			'time_on_page' : row[13] }
+
+# Daily YouTube snapshots for n video and day combinations, with a thousand videos per day
+def youtube_rows(n):
+	start = date(2016, 1, 1)
+	for i in xrange(n):
+		views = number(i, 0, 100000)
+		yield { 'date_id' : int((start + timedelta(days=i // 1000)).strftime('%Y%m%d')), 'video_id' : 'video%06d' % (i % 1000), \
+			'title' : 'Video %s' % (i % 1000), 'total_views' : views, 'views' : number(i, 1, 100), 'total_likes' : number(i, 2), \
+			'likes' : number(i, 3, 10), 'total_dislikes' : number(i, 4, 50), 'dislikes' : number(i, 5, 3), \
+			'publish_date' : '2016-01-01', 'channel' : 'Lightyear' }
+
+# Daily MailChimp list snapshots for n list and day combinations, with a hundred lists per day
+def mc_list_rows(n):
+	start = date(2016, 1, 1)
+	for i in xrange(n):
+		yield { 'date_id' : int((start + timedelta(days=i // 100)).strftime('%Y%m%d')), 'list_id' : 'list%06d' % (i % 100), \
+			'members' : number(i, 0, 50), 'unsubscribed' : number(i, 1, 5), 'cleaned' : number(i, 2, 5), \
+			'total_members' : number(i, 3, 100000), 'total_unsubscribed' : number(i, 4, 5000), 'total_cleaned' : number(i, 5, 5000), \
+			'total_campaigns' : number(i, 6, 500), 'open_rate' : number(i, 7, 100) / 100.0, 'avg_sub_rate' : number(i, 8, 100) / 10.0 }
+
+# Gets the value at a percentile (0 to 100) of a list of numbers, by the nearest rank
+def percentile(values, pct):
+	if len(values) == 0:
+		return(None)
+	values = sorted(values)
+	return(values[min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))])
+
+# Gets the peak resident memory of this process in megabytes, or of another process given its ru_maxrss.
+# Linux reports kilobytes and Mac OS bytes
+def peak_memory_mb(peak=None):
+	if peak is None:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if os.uname()[0] == 'Darwin':
+		peak /= 1024
+	return(round(peak / 1024.0, 1))
+
+# Class for timing the operations of a benchmark, where each operation processes a number of rows
+class Timer():
+	# Initialiser
+	def __init__(self):
+		self.latencies = []
+		self.rows = 0
+
+	# Call a function as one operation, counting rows towards the throughput. Returns the function's result
+	def time(self, rows, func, *args, **kwargs):
+		start = time.time()
+		result = func(*args, **kwargs)
+		self.latencies.append(time.time() - start)
+		self.rows += rows
+		return(result)
+
+	# Summarise throughput, operation latency percentiles in milliseconds and peak memory
+	def summary(self):
+		duration = sum(self.latencies)
+		return({
+			'rows' : self.rows,
+			'ops' : len(self.latencies),
+			'seconds' : round(duration, 3),
+			'rows_per_sec' : round(self.rows / duration, 1) if duration > 0 else None,
+			'p50_ms' : round(percentile(self.latencies, 50) * 1000, 3) if len(self.latencies) > 0 else None,
+			'p95_ms' : round(percentile(self.latencies, 95) * 1000, 3) if len(self.latencies) > 0 else None,
+			'p99_ms' : round(percentile(self.latencies, 99) * 1000, 3) if len(self.latencies) > 0 else None,
+			'peak_mb' : peak_memory_mb()
+		})
+
+# Gets the stored baselines, keyed by benchmark name and scale
+def load_baseline(baseline_file=BASELINE_FILE):
+	if not os.path.exists(baseline_file):
+		return({})
+	with open(baseline_file) as f:
+		return(json.load(f))
+
+# Store results as the new baselines, keeping baselines for benchmarks that were not run
+def save_baseline(results, baseline_file=BASELINE_FILE):
+	baseline = load_baseline(baseline_file)
+	baseline.update(dict([(key, result) for key, result in results.items() if result.get('rows_per_sec') is not None]))
+	if not os.path.isdir(os.path.dirname(baseline_file)):
+		os.makedirs(os.path.dirname(baseline_file))
+
+	tmp_file = '%s.tmp' % baseline_file
+	with open(tmp_file, 'w') as f:
+		json.dump(baseline, f, indent=2, sort_keys=True)
+	os.rename(tmp_file, baseline_file)
+
+# Compare results against the baselines. A regression is throughput falling, or p95 latency or peak memory rising,
+# by more than the tolerance. Returns a list of (benchmark, measure, baseline value, new value) for each regression
+def regressions(results, baseline, tolerance=0.2):
+	found = []
+	for key, result in sorted(results.items()):
+		if key not in baseline or result.get('rows_per_sec') is None:
+			continue
+		base = baseline[key]
+		if base.get('rows_per_sec') and result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+			found.append((key, 'rows_per_sec', base['rows_per_sec'], result['rows_per_sec']))
+		for measure in ['p95_ms', 'peak_mb']:
+			if base.get(measure) and result.get(measure) and result[measure] > base[measure] * (1 + tolerance):
+				found.append((key, measure, base[measure], result[measure]))
+	return(found)
@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+# Facebook Graph API extraction, through the shared HTTP request scheduler
+
+import lyf, logging
+import json
+import requests
+
+from lyf import trace	# Stage timings and counts
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent API calls
+
+# Base URL for the configured version of the Facebook Graph API
+def fb_graph_url():
+	return('https://graph.facebook.com/v' + lyf.get_config('FACEBOOK', 'API_Version'))
+
+# Get a path relative to the Facebook Graph API
+def fb_get(path, token=False):
+	if not token:
+		token = lyf.get_config('FACEBOOK', 'Access_Token')
+
+	with trace.span('extract', 'fb_query'):
+		r = lyf.http_request('GET', '%s/%s' % (fb_graph_url(), path), params={ 'access_token' : token })
+	return(r.json())
+
+# Iterate over the pages of a Graph API edge by following paging.next, yielding the data from each page.
+# Stops after max_pages if given, including the page passed in
+def iter_fb_pages(edge, max_pages=None):
+	pages = 0
+	while True:
+		yield edge.get('data', [])
+		pages += 1
+		if max_pages is not None and pages >= max_pages:
+			break
+
+		next_page = edge.get('paging', {}).get('next')
+		if next_page is None:
+			break
+		with trace.span('extract', 'fb_page') as span:
+			edge = lyf.http_request('GET', next_page).json()
+			span.add(rows=len(edge.get('data', [])))
+
+# Executes a subquery using the FB API, appending the results of multiple pages into the main array
+def fb_sub_query(orig_data, curr_data, max_pages=None):
+	pages = iter_fb_pages(curr_data, max_pages)
+	next(pages) # First page is already in the main array
+	for data in pages:
+		orig_data['data'].extend(data)
+
+# Follow the paging of any edges in several sets of Graph API results. Each edge must be paged through in order, but
+# separate edges are followed concurrently
+def fb_expand_all(results, max_pages=None, workers=4):
+	edges = []
+	for result in results:
+		for prop in result:
+			if isinstance(result[prop], dict):
+				if 'next' in result[prop].get('paging', {}):
+					edges.append(result[prop])
+
+	if len(edges) == 1:
+		fb_sub_query(edges[0], edges[0], max_pages)
+	elif len(edges) > 1:
+		pool = ThreadPool(min(workers, len(edges)))
+		try:
+			pool.map(lambda edge: fb_sub_query(edge, edge, max_pages), edges)
+		finally:
+			pool.terminate()
+	return(results)
+
+# Follow the paging of any edges in a set of Graph API results
+def fb_expand(results, max_pages=None):
+	return(fb_expand_all([results], max_pages)[0])
+
+# Path for querying fields of own page, as the access token is for own page
+def fb_query_path(fields):
+	return('me?fields=%s' % fields)
+
+# Path for querying insights of own page
+def fb_insights_path(metrics, period=False, since=False, until=False):
+	path = 'me/insights/%s' % ','.join(metrics)
+
+	if period:
+		if not period in ['day', 'week', 'month', 'days_28', 'lifetime']:
+			period = False
+
+	if period:
+		path += '?period=%s' % period
+		if since:
+			path += '&since=%s' % since
+		if until:
+			path += '&until=%s' % until
+	return(path)
+
+# Query Facebook Graph API to get page information
+def fb_query(fields, token=False, max_pages=None):
+	results = fb_get(fb_query_path(fields), token)
+	return(fb_expand(results, max_pages))
+
+# Insights queries require read_insights privilege
+def fb_insights_query(metrics, period=False, since=False, until=False, token=False, max_pages=None):
+	results = fb_get(fb_insights_path(metrics, period, since, until), token)
+	return(fb_expand(results, max_pages))
+
+# Send several Graph API queries, given as relative paths, in a single batch request. Returns the results of each
+def fb_batch(paths, token=False, max_pages=None):
+	if not token:
+		token = lyf.get_config('FACEBOOK', 'Access_Token')
+
+	batch = json.dumps([{ 'method' : 'GET', 'relative_url' : path } for path in paths])
+	with trace.span('extract', 'fb_batch'):
+		r = lyf.http_request('POST', fb_graph_url(), data={ 'access_token' : token, 'batch' : batch })
+
+	results = []
+	for response in r.json():
+		if response is None or response['code'] != 200:
+			error = 'Facebook batch request failed: %s' % (response and response.get('body'))
+			raise requests.HTTPError(error, response=r)
+		results.append(json.loads(response['body']))
+	return(fb_expand_all(results, max_pages))
+
+# Renew Facebook access token
+def renew_fb_token():
+	url = fb_graph_url()
+	url += '/oauth/access_token?grant_type=fb_exchange_token&client_id=%s' % lyf.get_config('FACEBOOK', 'App_ID')
+	url += '&client_secret=%s&Reset&fb_exchange_token=%s' % (lyf.get_config('FACEBOOK', 'App_Secret'), lyf.get_config('FACEBOOK', 'Access_Token'))
+
+	r = lyf.http_request('GET', url)
+	new_token = r.json()['access_token']
+	perm_token = fb_query('access_token', new_token)['access_token']
+
+	lyf.write_config('FACEBOOK', 'Access_Token', perm_token)
+	logging.info('New Facebook access token written to %s.' % lyf.CONFIG)
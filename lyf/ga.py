@@ -0,0 +1,534 @@
+#! /usr/bin/env python
+# Google Analytics extraction and the Google API services shared with YouTube. The Google API client, OAuth2 and
+# dateutil libraries are imported on first use, so importing this module is cheap
+
+import lyf, logging
+import os
+import re
+import errno
+import csv
+import json
+import time
+import socket
+import tempfile
+import hashlib
+import calendar
+import threading
+import collections
+
+from lyf import trace	# Stage timings and counts
+from datetime import date, timedelta, datetime	# Date time
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent API calls
+
+# Google Analytics limits
+global GA_SCOPES, GA_MAX_WORKERS, GA_RATE_LIMIT_REASONS, GA_MAX_DIMENSIONS, GA_MAX_METRICS
+GA_SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
+GA_MAX_WORKERS = lyf.HOST_LIMITS['www.googleapis.com'] # Concurrent requests allowed per view
+GA_RATE_LIMIT_REASONS = ['userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded']
+GA_MAX_DIMENSIONS = 7 # Per query
+GA_MAX_METRICS = 10 # Per query
+
+# Google Analytics extracts for the fact table and blog page details
+global GA_FACT_DIMENSIONS, GA_FACT_METRICS, GA_BLOG_DIMENSIONS, GA_BLOG_FILTERS
+GA_FACT_DIMENSIONS = ['ga:date', 'ga:cityId', 'ga:sourceMedium', 'ga:pageTitle', 'ga:longitude', 'ga:latitude', 'ga:userType']
+GA_FACT_METRICS = ['ga:sessions', 'ga:bounces', 'ga:bounceRate', 'ga:avgSessionDuration', 'ga:sessionDuration', \
+	'ga:pageviews', 'ga:timeOnPage']
+GA_BLOG_DIMENSIONS = ['ga:pageTitle', 'ga:contentGroup1', 'ga:contentGroup2']
+GA_BLOG_FILTERS = 'ga:contentGroup1==Blog;ga:contentGroup2!=(not set)'
+
+# Google API discovery documents, and the seconds before expiry at which a cached access token is refreshed
+global GOOGLE_DISCOVERY_URL, GOOGLE_TOKEN_MARGIN
+GOOGLE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+GOOGLE_TOKEN_MARGIN = 60
+
+GOOGLE_SERVICES = {}
+GOOGLE_CREDENTIALS = {}
+GOOGLE_LOCK = threading.RLock()
+
+# Reads the Google Analytics dimension definitions from the configured TSV file.
+# Returns a list of (table, GA dimensions, columns, keys)
+def get_ga_dims():
+	file = os.path.join(lyf.SCRIPT_DIR, lyf.get_config('ETL', 'GA_Dims'))
+
+	dims = []
+	with open(file, 'r') as f:
+		f = csv.reader(f, delimiter='\t')
+		i = 0
+		for row in f:
+			if (i > 0):
+				if (len(row) > 0):
+					dims.append((row[0], row[1].split(','), row[2].split(','), row[3].split(',')))
+			i += 1
+	return(dims)
+
+# Whether Google API traffic is authorised, i.e. not replayed or sent to the stand-in server
+def google_authorised():
+	from lyf import replay	# Record and replay API traffic
+	return(replay.replay_mode() in [None, 'record'])
+
+# Directory caching discovery documents and access tokens, relative to the scripts
+def google_cache_dir():
+	return(os.path.join(lyf.SCRIPT_DIR, lyf.get_config('GOOGLE_ANALYTICS', 'Cache_Dir', 'cache')))
+
+# Write a cache file atomically, readable only by its owner as it may hold an access token. Each writer uses its own
+# temporary file, so concurrent processes replace the cache whole and the last to finish wins. The cache only saves
+# requests, so a failed write is logged rather than raised
+def write_cache(path, content):
+	cache_dir = os.path.dirname(path)
+	tmp_file = None
+	try:
+		try:
+			os.makedirs(cache_dir)
+		except OSError as err:
+			if err.errno != errno.EEXIST: # Created by another process
+				raise
+
+		fd, tmp_file = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=cache_dir)
+		os.chmod(tmp_file, 0600)
+		with os.fdopen(fd, 'w') as f:
+			f.write(content)
+		os.rename(tmp_file, path)
+		return(True)
+	except (IOError, OSError) as err:
+		logging.warning('Could not write cache file %s: %s' % (path, err))
+		if tmp_file is not None and os.path.exists(tmp_file):
+			os.remove(tmp_file)
+		return(False)
+
+# Fetch a discovery document. They are public, so the connection is not authorised
+def fetch_discovery(api, version):
+	from lyf import replay	# Record and replay API traffic
+
+	url = GOOGLE_DISCOVERY_URL % (api, version)
+	response, content = replay.replay_http().request(url)
+	if response.status != 200:
+		raise IOError('Failed to fetch the discovery document for %s %s: HTTP %s.' % (api, version, response.status))
+	json.loads(content) # Never cache a broken document
+	return(content)
+
+# Gets the discovery document for a Google API and version. Each version is cached on disk for GOOGLE_ANALYTICS
+# Discovery_TTL seconds, and an expired copy is used if a new one cannot be fetched. Replayed and stand-in documents
+# are not cached, so they never replace the live ones
+def discovery_document(api, version):
+	if not google_authorised():
+		return(fetch_discovery(api, version))
+
+	path = os.path.join(google_cache_dir(), 'discovery', '%s.%s.json' % (api, version))
+	ttl = float(lyf.get_config('GOOGLE_ANALYTICS', 'Discovery_TTL', 86400))
+	if os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl:
+		with open(path) as f:
+			return(f.read())
+
+	try:
+		content = fetch_discovery(api, version)
+	except Exception as err:
+		if not os.path.exists(path):
+			raise
+		logging.warning('Using expired discovery document for %s %s: %s' % (api, version, err))
+		with open(path) as f:
+			return(f.read())
+	write_cache(path, content)
+	return(content)
+
+# Gets the service account credentials for a set of scopes, shared by every thread, and the file caching their access
+# token. A token cached by an earlier process is reused until it expires
+def google_credentials(scopes):
+	from oauth2client.service_account import ServiceAccountCredentials	# Google authenticator
+
+	key = tuple(sorted(scopes))
+	with GOOGLE_LOCK:
+		if key not in GOOGLE_CREDENTIALS:
+			key_file = os.path.join(lyf.SCRIPT_DIR, lyf.get_config('GOOGLE_ANALYTICS','Key_File'))
+			credentials = ServiceAccountCredentials.from_json_keyfile_name(key_file, scopes=scopes)
+			token_file = os.path.join(google_cache_dir(), 'tokens', '%s.json' % \
+				hashlib.sha1(json.dumps([key_file] + list(key))).hexdigest())
+
+			if os.path.exists(token_file):
+				try:
+					with open(token_file) as f:
+						token = json.load(f)
+					credentials.access_token = token['access_token']
+					credentials.token_expiry = datetime.utcfromtimestamp(token['expiry'])
+				except (IOError, ValueError, KeyError) as err:
+					logging.warning('Ignoring cached access token %s: %s' % (token_file, err))
+			GOOGLE_CREDENTIALS[key] = (credentials, token_file)
+		return(GOOGLE_CREDENTIALS[key])
+
+# Refresh the access token for a set of scopes if it has expired or is about to, caching the new token on disk
+def google_token(scopes):
+	import httplib2
+
+	credentials, token_file = google_credentials(scopes)
+	with GOOGLE_LOCK:
+		expiry = credentials.token_expiry
+		if credentials.access_token is None or expiry is None or \
+			expiry - datetime.utcnow() < timedelta(seconds=GOOGLE_TOKEN_MARGIN):
+			credentials.refresh(httplib2.Http())
+			token = { 'access_token' : credentials.access_token, \
+				'expiry' : calendar.timegm(credentials.token_expiry.utctimetuple()) }
+			write_cache(token_file, json.dumps(token))
+	return(credentials)
+
+# Gets the calling thread's connection for a set of scopes, authorised with the shared credentials unless traffic is
+# replayed. httplib2 connections cannot be shared between threads
+def google_http(scopes):
+	from lyf import replay	# Record and replay API traffic
+
+	if not hasattr(lyf.THREAD_DATA, 'google_http'):
+		lyf.THREAD_DATA.google_http = {}
+	key = tuple(sorted(scopes))
+	if key not in lyf.THREAD_DATA.google_http:
+		http = replay.replay_http()
+		if google_authorised():
+			http = google_credentials(scopes)[0].authorize(http)
+		lyf.THREAD_DATA.google_http[key] = http
+	return(lyf.THREAD_DATA.google_http[key])
+
+# Class standing in for the connection of a shared Google API service. Each request is sent with the calling thread's
+# own connection, after refreshing the access token if needed
+class ThreadHttp():
+	# Initialiser
+	def __init__(self, scopes):
+		self.scopes = list(scopes)
+		self.authorised = google_authorised()
+
+	# Send a request, returning the response headers and content
+	def request(self, *args, **kwargs):
+		if self.authorised:
+			google_token(self.scopes)
+		return(google_http(self.scopes).request(*args, **kwargs))
+
+	# Any other attribute is the calling thread's connection's
+	def __getattr__(self, name):
+		return(getattr(google_http(self.scopes), name))
+
+# Gets the service for a Google API and version, built once per process from the cached discovery document and shared
+# by every thread. Replayed and stand-in traffic is not authorised
+def google_api(api, version, scopes):
+	from apiclient.discovery import build_from_document	# Builds Google API service
+
+	key = (api, version, tuple(sorted(scopes)))
+	with GOOGLE_LOCK:
+		if key not in GOOGLE_SERVICES:
+			GOOGLE_SERVICES[key] = build_from_document(discovery_document(api, version), http=ThreadHttp(scopes))
+		return(GOOGLE_SERVICES[key])
+
+# Use the API service object to get the first profile id
+def get_ga_profile(service):
+	# Get a list of all Google Analytics accounts for this user
+	accounts = service.management().accounts().list().execute()
+
+	if accounts.get('items'):
+		# Get the first Google Analytics account.
+		account = accounts.get('items')[0].get('id')
+
+	# Get a list of all the properties for the first account.
+	properties = service.management().webproperties().list(accountId=account).execute()
+
+	if properties.get('items'):
+		# Get the first property id.
+		property = properties.get('items')[0].get('id')
+
+	# Get a list of all views (profiles) for the first property.
+	profiles = service.management().profiles().list(accountId=account, webPropertyId=property).execute()
+
+	if profiles.get('items'):
+		# return the first view (profile) id.
+		return profiles.get('items')[0].get('id')
+
+	return None
+
+# Whether a Google API request should be retried: rate limit and quota errors, server errors and connection failures
+def ga_retry_delay(host, result, err):
+	if err is None:
+		return(None)
+
+	# Already loaded by the request that failed
+	import httplib2
+	from apiclient.errors import HttpError	# Google API errors
+
+	if isinstance(err, (socket.error, httplib2.HttpLib2Error)):
+		return(0)
+	if not isinstance(err, HttpError):
+		return(None)
+
+	try:
+		reason = json.loads(err.content)['error']['errors'][0]['reason']
+	except Exception:
+		reason = None
+	if reason in GA_RATE_LIMIT_REASONS or err.resp.status in lyf.RETRY_STATUSES:
+		return(lyf.retry_after(err.resp.get('retry-after')))
+	return(None)
+
+# Gets the shared Google Analytics service
+def ga_service():
+	return(google_api('analytics', 'v3', GA_SCOPES))
+
+# Execute a Google API request through the request scheduler, retrying when the rate limit or quota is exceeded
+def ga_execute(request, retries=lyf.RETRY_LIMIT):
+	postproc = request.postproc
+
+	# Count the size of the response before it is parsed
+	def measured(resp, content):
+		trace.add(bytes=len(content))
+		return(postproc(resp, content))
+
+	request.postproc = measured
+	return(lyf.api_call(lyf.api_host(request.uri), request.execute, ga_retry_delay, retries))
+
+# Split a date range into day, week (Monday to Sunday) or month shards. Returns a list of (start, end) date strings
+def ga_date_shards(start_date, end_date, shard='month'):
+	from dateutil.parser import parse	# Date parser
+
+	start = parse(start_date).date()
+	end = parse(end_date).date()
+
+	shards = []
+	while start <= end:
+		if shard == 'day':
+			shard_end = start
+		elif shard == 'week':
+			shard_end = start + timedelta(days=6 - start.weekday())
+		elif shard == 'month':
+			shard_end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+		else:
+			raise ValueError('Invalid shard size: %s' % shard)
+
+		shard_end = min(shard_end, end)
+		shards.append((start.strftime('%Y-%m-%d'), shard_end.strftime('%Y-%m-%d')))
+		start = shard_end + timedelta(days=1)
+
+	return(shards)
+
+# Query Google Analytics API, yielding each page of rows as it is fetched. Pages are followed iteratively by start-index.
+# If info is given, its 'sampled' value is set when any page contains sampled data
+def iter_ga_pages(service, start_date, end_date, metrics, dimensions=None, filters=None, max_results=10000, \
+	sampling_level=None, info=None):
+	query = {
+		'ids' : 'ga:' + lyf.get_config('GOOGLE_ANALYTICS', 'Profile'),
+		'start_date' : start_date,
+		'end_date' : end_date,
+		'metrics' : metrics,
+		'max_results' : max_results
+	}
+	if dimensions is not None:
+		query['dimensions'] = dimensions
+	if filters is not None:
+		query['filters'] = filters
+	if sampling_level is not None:
+		query['samplingLevel'] = sampling_level
+
+	start_index = 1
+	while True:
+		with trace.span('extract', 'ga_page') as span:
+			results = ga_execute(service.data().ga().get(start_index=start_index, **query))
+			span.add(rows=len(results.get('rows', [])))
+		if info is not None and results.get('containsSampledData'):
+			info['sampled'] = True
+		rows = results.get('rows', [])
+		if len(rows) == 0:
+			break
+
+		yield rows
+		start_index = int(results['query']['start-index']) + len(rows)
+		if results['totalResults'] < start_index:
+			break
+
+# Fetch all rows for a single date shard on a worker thread. Sampled shards spanning several days are re-fetched a
+# day at a time, as GA samples on the number of sessions in the requested range
+def fetch_ga_shard(args):
+	start_date, end_date, metrics, dimensions, filters = args
+	service = ga_service()
+	info = {}
+	rows = []
+	for page in iter_ga_pages(service, start_date, end_date, metrics, dimensions, filters, \
+		sampling_level='HIGHER_PRECISION', info=info):
+		rows.extend(page)
+
+	if info.get('sampled'):
+		if start_date != end_date:
+			rows = []
+			for day_start, day_end in ga_date_shards(start_date, end_date, 'day'):
+				rows.extend(fetch_ga_shard((day_start, day_end, metrics, dimensions, filters)))
+		else:
+			logging.warning('Google Analytics results for %s contain sampled data.' % start_date)
+	return(rows)
+
+# Query Google Analytics API over date shards ('day', 'week' or 'month') fetched concurrently on a bounded thread pool.
+# Yields a tuple of ((start date, end date), rows) for every shard in date order, including empty ones. Only as many
+# shards as there are workers are fetched ahead of the caller, so a slow load does not hold every shard in memory
+def iter_ga_chunks(start_date, end_date, metrics, dimensions=None, filters=None, shard='month', workers=4):
+	dates = ga_date_shards(start_date, end_date, shard)
+	size = max(1, min(workers, GA_MAX_WORKERS, len(dates)))
+	pool = ThreadPool(size)
+	pending = collections.deque()
+	try:
+		for start, end in dates:
+			pending.append(((start, end), pool.apply_async(fetch_ga_shard, ((start, end, metrics, dimensions, filters),))))
+			if len(pending) >= size:
+				chunk, result = pending.popleft()
+				yield (chunk, result.get())
+		while len(pending) > 0:
+			chunk, result = pending.popleft()
+			yield (chunk, result.get())
+	finally:
+		pool.terminate()
+
+# Query Google Analytics API over date shards fetched concurrently. Yields each shard's rows in date order
+def iter_ga_shards(start_date, end_date, metrics, dimensions=None, filters=None, shard='month', workers=4):
+	for dates, rows in iter_ga_chunks(start_date, end_date, metrics, dimensions, filters, shard, workers):
+		if len(rows) > 0:
+			yield rows
+
+# Query Google Analytics API, yielding pages of rows. Without a shard size the range is paged through in one query,
+# downloading the next page in the background while the current one is being consumed
+def iter_ga_results(service, start_date, end_date, metrics, dimensions=None, filters=None, shard=None, workers=4):
+	if shard is None:
+		return(lyf.prefetch(iter_ga_pages(service, start_date, end_date, metrics, dimensions, filters)))
+	else:
+		return(iter_ga_shards(start_date, end_date, metrics, dimensions, filters, shard, workers))
+
+# Query Google Analytics API, yielding individual rows
+def iter_ga_rows(service, start_date, end_date, metrics, dimensions=None, filters=None, shard=None, workers=4):
+	for page in iter_ga_results(service, start_date, end_date, metrics, dimensions, filters, shard, workers):
+		for row in page:
+			yield row
+
+# Query Google Analytics API to retrieve some data
+def ga_query(service, start_date, end_date, metrics, dimensions=None, filters=None, shard=None, workers=4):
+	results = []
+	if shard is None:
+		pages = iter_ga_pages(service, start_date, end_date, metrics, dimensions, filters)
+	else:
+		pages = iter_ga_shards(start_date, end_date, metrics, dimensions, filters, shard, workers)
+	for page in pages:
+		results.extend(page)
+	return(results)
+
+# Class for a table extracted from Google Analytics. Dimension targets take the distinct values of their dimensions
+# from any query that includes them, whereas fact targets need a query with exactly their dimensions so that their
+# metrics are not split further
+class GA_Target():
+	def __init__(self, name, dimensions, metrics=['ga:sessions'], filters=None, fact=False): # Initialiser
+		self.name = name
+		self.dimensions = list(dimensions)
+		self.metrics = list(metrics)
+		self.filters = filters
+		self.fact = fact
+		self.conditions = ga_conditions(filters)
+
+	# Dimensions needed to evaluate the target's filters in memory
+	def filter_dimensions(self):
+		if self.conditions is None:
+			return([])
+		return([dim for dim, op, val in self.conditions])
+
+# Class for a planned Google Analytics query and the targets projected from its results
+class GA_Query():
+	def __init__(self, target): # Initialiser
+		self.dimensions = list(target.dimensions)
+		self.metrics = list(target.metrics)
+		self.fact = target.fact
+		self.targets = [target]
+
+	# Whether a target's rows can be projected from this query, if necessary by adding its dimensions
+	def fits(self, target):
+		if target.fact:
+			return(False)
+		for existing in self.targets + [target]:
+			if existing.filters is not None and existing.conditions is None:
+				return(False) # Filter can only be applied by the API
+
+		dims = set(self.dimensions) | self.required_dimensions(self.targets + [target])
+		if self.fact:
+			return(len(dims) == len(self.dimensions))
+		return(len(dims) <= GA_MAX_DIMENSIONS)
+
+	# Add a target to the query
+	def add(self, target):
+		self.targets.append(target)
+		for existing in self.targets:
+			for dim in existing.dimensions + existing.filter_dimensions():
+				if dim not in self.dimensions:
+					self.dimensions.append(dim)
+
+	# Dimensions needed to project a set of targets and apply their filters in memory
+	def required_dimensions(self, targets):
+		dims = set()
+		for target in targets:
+			dims.update(target.dimensions + target.filter_dimensions())
+		return(dims)
+
+	# Filters sent to the API, only used when the query serves a single target
+	def filters(self):
+		if len(self.targets) == 1:
+			return(self.targets[0].filters)
+		return(None)
+
+	# Project a page of results onto each target, applying the filters of shared queries in memory.
+	# Returns a dictionary of target names to rows. Dimension targets get distinct rows
+	def project(self, rows):
+		projected = {}
+		for target in self.targets:
+			dim_idx = [self.dimensions.index(dim) for dim in target.dimensions]
+			metric_idx = [len(self.dimensions) + self.metrics.index(metric) for metric in target.metrics]
+			idx = dim_idx + metric_idx if target.fact else dim_idx
+
+			matches = []
+			if self.filters() is None and target.conditions is not None:
+				for dim, op, val in target.conditions:
+					matches.append((self.dimensions.index(dim), op == '==', val))
+
+			out = collections.OrderedDict()
+			for row in rows:
+				if all([(row[i] == val) == equal for i, equal, val in matches]):
+					rec = tuple([row[i] for i in idx])
+					if target.fact:
+						out[len(out)] = rec
+					else:
+						out[rec] = rec
+			projected[target.name] = [list(rec) for rec in out.values()]
+		return(projected)
+
+# Parse simple Google Analytics filters (conditions of == or != joined by ;) into a list of (dimension, operator, value)
+# so that they can be applied in memory. Returns None for any other filter
+def ga_conditions(filters):
+	if filters is None:
+		return(None)
+	conditions = []
+	for condition in filters.split(';'):
+		match = re.match('^(ga:\w+)(==|!=)([^,]*)$', condition)
+		if match is None:
+			return(None)
+		conditions.append(match.groups())
+	return(conditions)
+
+# Work out a minimal set of Google Analytics queries covering a list of targets. Fact targets get their own query,
+# then each dimension target is projected from an existing query where possible, largest first
+def plan_ga_queries(targets):
+	queries = [GA_Query(target) for target in targets if target.fact]
+	dim_targets = sorted([target for target in targets if not target.fact], key=lambda target: -len(target.dimensions))
+
+	for target in dim_targets:
+		# Prefer queries that already have all the target's dimensions
+		candidates = [query for query in queries if query.fits(target)]
+		candidates.sort(key=lambda query: len(query.required_dimensions([target]) - set(query.dimensions)))
+		if len(candidates) > 0:
+			candidates[0].add(target)
+		else:
+			queries.append(GA_Query(target))
+
+	for query in queries:
+		if len(query.metrics) > GA_MAX_METRICS:
+			raise ValueError('Too many metrics in Google Analytics query: %s' % ','.join(query.metrics))
+	return(queries)
+
+# Run each planned query once, projecting each page of its rows onto every target as it arrives. Yields a dictionary
+# of target names to the rows projected from a page. Queries for dimensions alone run before the fact queries, so
+# that the dimensions are loaded before the facts resolve them. Dimension rows are distinct within a page only
+def run_ga_plan(queries, start_date, end_date, shard=None, workers=4):
+	for query in sorted(queries, key=lambda query: query.fact):
+		metrics = ','.join(query.metrics)
+		dims = ','.join(query.dimensions)
+		for page in iter_ga_results(ga_service(), start_date, end_date, metrics, dims, query.filters(), shard, workers):
+			yield query.project(page)
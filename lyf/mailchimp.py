@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# MailChimp extraction, through the shared HTTP request scheduler
+
+import lyf, logging
+import re
+
+from lyf import trace	# Stage timings and counts
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent API calls
+
+# MailChimp fields used by MC_List and MC_Campaign
+global MC_LIST_FIELDS, MC_CAMPAIGN_FIELDS
+MC_LIST_FIELDS = ['id', 'name', 'date_created', 'subscribe_url_short', 'stats.member_count', 'stats.unsubscribe_count', \
+	'stats.cleaned_count', 'stats.campaign_count', 'stats.open_rate', 'stats.click_rate', 'stats.avg_sub_rate', \
+	'stats.campaign_last_sent', 'stats.last_sub_date']
+MC_CAMPAIGN_FIELDS = ['id', 'settings.title', 'settings.subject_line', 'create_time', 'emails_sent', \
+	'report_summary.open_rate', 'report_summary.click_rate', 'report_summary.subscriber_clicks', \
+	'report_summary.clicks', 'report_summary.opens', 'report_summary.unique_opens']
+
+# Class for MailChimp subscriber lists
+class MC_List():
+	def __init__(self, id, name, created_date, subscribe_url='', total_members=0, \
+		total_unsubscribed=0, total_cleaned=0, total_campaigns=0, open_rate=0, click_rate=0, \
+		avg_sub_rate=0, last_campaign=None, last_subscriber=None): # Initialiser
+		from dateutil.parser import parse	# Date parser
+
+		self.list_id = id
+		self.name = name
+		self.created_date = parse(created_date)
+		self.subscribe_url = subscribe_url
+		self.total_members = int(total_members)
+		self.total_unsubscribed = int(total_unsubscribed)
+		self.total_cleaned = int(total_cleaned)
+		self.total_campaigns = int(total_campaigns)
+		self.open_rate = float(open_rate)
+		self.avg_sub_rate = float(avg_sub_rate)
+		self.last_campaign = parse(last_campaign)
+		self.last_subscriber = parse(last_subscriber)
+
+class MC_Campaign():
+	def __init__(self, id, name, subject, created, emails_sent, open_rate, click_rate, subscriber_clicks, clicks, opens, \
+	 	unique_opens):
+		self.campaign_id = id
+		self.name = name
+		self.subject = subject
+		self.emails_sent = emails_sent
+		self.created_date = created
+		self.emails_sent = emails_sent
+		self.open_rate = open_rate
+		self.click_rate = click_rate
+		self.subscriber_clicks = subscriber_clicks
+		self.clicks = clicks
+		self.opens = opens
+
+# Gets the base URL and credentials for the MailChimp API
+def mc_api():
+	user = lyf.get_config('MAILCHIMP', 'User')
+	api_key = lyf.get_config('MAILCHIMP', 'API_Key')
+	dc = re.search('-(.*?)$', api_key).group(1)
+	return('https://%s.api.mailchimp.com/3.0' % dc, (user, api_key))
+
+# Get every item of a MailChimp collection, requesting only the given fields of each item. The first page gives the
+# total number of items, then the remaining pages are fetched concurrently and returned in order
+def mc_collection(path, key, fields, query_string=False, count=500, workers=4):
+	base_url, auth = mc_api()
+	if not query_string:
+		url = '%s/%s' % (base_url, path)
+	else:
+		url = '%s/%s?%s' % (base_url, path, query_string)
+	fields = ','.join(['total_items'] + ['%s.%s' % (key, field) for field in fields])
+
+	def fetch_page(offset):
+		with trace.span('extract', 'mc_page') as span:
+			page = lyf.http_request('GET', url, params={ 'count' : count, 'offset' : offset, 'fields' : fields }, auth=auth).json()
+			span.add(rows=len(page[key]))
+		return(page)
+
+	results = fetch_page(0)
+	items = results[key]
+	offsets = range(count, results['total_items'], count)
+	if len(offsets) > 0:
+		pool = ThreadPool(min(workers, len(offsets)))
+		try:
+			for page in pool.imap(fetch_page, offsets):
+				items.extend(page[key])
+		finally:
+			pool.terminate()
+	return(items)
+
+# Get MailChimp subscriber lists
+def get_mc_lists(query_string=False):
+	results = mc_collection('lists', 'lists', MC_LIST_FIELDS, query_string)
+
+	lists = []
+	for list in results:
+		new_list = MC_List(list['id'], list['name'], list['date_created'], list['subscribe_url_short'], \
+			list['stats']['member_count'], list['stats']['unsubscribe_count'], list['stats']['cleaned_count'], \
+			list['stats']['campaign_count'], list['stats']['open_rate'], list['stats']['click_rate'], \
+			list['stats']['avg_sub_rate'], list['stats']['campaign_last_sent'], list['stats']['last_sub_date'] \
+		)
+		lists.append(new_list)
+
+	return(lists)
+
+# Get MailChimp campaigns
+def get_mc_campaigns():
+	results = mc_collection('campaigns', 'campaigns', MC_CAMPAIGN_FIELDS)
+
+	campaigns = []
+	for campaign in results:
+		new_campaign = MC_Campaign(campaign['id'], campaign['settings']['title'], campaign['settings']['subject_line'], \
+			campaign['create_time'], campaign['emails_sent'], campaign['report_summary']['open_rate'], \
+			campaign['report_summary']['click_rate'], campaign['report_summary']['subscriber_clicks'], \
+			campaign['report_summary']['clicks'], campaign['report_summary']['opens'], \
+		 	campaign['report_summary']['unique_opens'])
+		campaigns.append(new_campaign)
+
+	return(campaigns)
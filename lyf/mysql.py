@@ -6,6 +6,7 @@ import MySQLdb
 import codecs
 import re
 
+from lyf import ga	# Google Analytics extraction
 from datetime import date, timedelta, datetime	# Date time
 from dateutil.parser import parse	# Date parser
 
@@ -79,10 +80,10 @@ def load_ga_dim(full_mode, table, ga_dims, columns, keys):
 			start_date = end_date
 
 		# Connect to Google Analytics
-		service = lyf.google_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics.readonly'])
+		service = ga.google_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics.readonly'])
 		metrics = 'ga:sessions'
 		dims = ','.join(ga_dims)
-		results = lyf.ga_query(service, start_date, end_date, metrics, dims)
+		results = ga.ga_query(service, start_date, end_date, metrics, dims)
 
 		for row in results:
 			rec = {}
@@ -2,38 +2,73 @@
 # LYF data integration function library
 
 import lyf, logging
+import os
 import psycopg2
 import codecs
 import re
 import csv
-
+import collections
+import contextlib
+import threading
+import psycopg2.pool
+
+from lyf import ga	# Google Analytics extraction
+from lyf import trace	# Stage timings and counts
+from cStringIO import StringIO	# In-memory buffer for COPY
 from datetime import date, timedelta, datetime	# Date time
-from dateutil.parser import parse	# Date parser
+
+# Shared connection pool, created on first use
+POOL = None
+POOL_LOCK = threading.Lock()
+
+# Pooled sessions open on each thread, and threads whose work has been cancelled, so that a job which has overrun
+# can be stopped
+SESSIONS = collections.defaultdict(list)
+CANCELLED = set()
+SESSIONS_LOCK = threading.Lock()
 
 # Class for youtube videos
 class DB():
-	# Initialiser
-	def __init__(self):
-		psql_db = lyf.get_config('POSTGRESQL', 'Database')
-		psql_user = lyf.get_config('POSTGRESQL', 'Username')
-		psql_schema = lyf.get_config('POSTGRESQL', 'Default_Schema')
+	# Initialiser. Pooled connections are borrowed from the shared pool and returned to it on close
+	def __init__(self, pooled=False):
+		self.thread = threading.current_thread().ident
+		if pooled:
+			self.pool = get_pool()
+			self.conn = checkout(self.pool)
+			self.cursor = self.conn.cursor()
+			with SESSIONS_LOCK:
+				cancelled = self.thread in CANCELLED
+				if not cancelled:
+					SESSIONS[self.thread].append(self)
+			if cancelled:
+				self.cursor.close()
+				self.pool.putconn(self.conn)
+				raise psycopg2.OperationalError('Work on this thread has been cancelled.')
+		else:
+			psql_db = lyf.get_config('POSTGRESQL', 'Database')
+			psql_user = lyf.get_config('POSTGRESQL', 'Username')
+			psql_schema = lyf.get_config('POSTGRESQL', 'Default_Schema')
 
-		self.conn = psycopg2.connect('dbname=%s user=%s' % (psql_db, psql_user))
-		self.cursor = self.conn.cursor()
-		self.execute("SET search_path = '%s';" % psql_schema)
+			self.pool = None
+			self.conn = psycopg2.connect('dbname=%s user=%s' % (psql_db, psql_user))
+			self.cursor = self.conn.cursor()
+			self.execute("SET search_path = '%s';" % psql_schema)
 
 	# Execute SQL and optionally commit or rollback. Return 1 for success, 0 for error
 	def execute(self, sql, values=[], commit=False, log=True):
-		try:
-			self.cursor.execute(sql, values)
-			if commit:
-				self.conn.commit()
-			return(1)
-		except Exception as err:
-			self.conn.rollback()
-			if log:
-				logging.error('PSQL Error: %s' % err)
-			return(0)
+		with trace.span('load', 'execute') as span:
+			trace.add(statements=1)
+			try:
+				self.cursor.execute(sql, values)
+				if commit:
+					self.conn.commit()
+				return(1)
+			except Exception as err:
+				span.add(errors=1)
+				self.conn.rollback()
+				if log:
+					logging.error('PSQL Error: %s' % err)
+				return(0)
 
 	# Truncate table
 	def truncate(self, table):
@@ -41,6 +76,7 @@ class DB():
 		return(self.execute(sql))
 
 	# Insert a single row to a table
+	@trace.traced('load', 'insert', rows=lambda status: status)
 	def insert(self, table, row):
 		sql = 'INSERT INTO %s (' % qualify_schema(table)
 		sql += ', '.join(row.keys())
@@ -52,7 +88,61 @@ class DB():
 		status = self.execute(sql, values) # Attempt to insert the record
 		return(status)
 
+	# Bulk insert rows (dictionaries) to a table using COPY FROM STDIN, buffering batch_size rows in memory at a time.
+	# Each batch is loaded under its own savepoint, so a bad batch is rolled back without losing the others.
+	# Returns a tuple of (rows inserted, rows failed)
+	@trace.traced('load', 'insert_many', rows=lambda result: result[0])
+	def insert_many(self, table, rows, batch_size=10000, log=True):
+		success, failed = 0, 0
+		columns = None
+		batch = []
+
+		for row in rows:
+			if columns is None:
+				columns = row.keys()
+			batch.append(row)
+			if len(batch) >= batch_size:
+				status = self.copy_rows(table, columns, batch, log)
+				success += status * len(batch)
+				failed += (1 - status) * len(batch)
+				batch = []
+
+		if len(batch) > 0:
+			status = self.copy_rows(table, columns, batch, log)
+			success += status * len(batch)
+			failed += (1 - status) * len(batch)
+
+		return(success, failed)
+
+	# Stream a single batch of rows into a table with COPY. Return 1 for success, 0 for error
+	def copy_rows(self, table, columns, rows, log=True):
+		buf = StringIO()
+		for row in rows:
+			buf.write('\t'.join([copy_value(row[col]) for col in columns]))
+			buf.write('\n')
+		size = buf.tell()
+		buf.seek(0)
+
+		sql = 'COPY %s (%s) FROM STDIN;' % (qualify_schema(table), ', '.join(columns))
+		with trace.span('load', 'copy') as span:
+			trace.add(bytes=size, statements=1)
+			try:
+				self.cursor.execute('SAVEPOINT copy_batch;')
+				self.cursor.copy_expert(sql, buf)
+				self.cursor.execute('RELEASE SAVEPOINT copy_batch;')
+				span.add(rows=len(rows))
+				return(1)
+			except Exception as err:
+				span.add(errors=1)
+				self.cursor.execute('ROLLBACK TO SAVEPOINT copy_batch;')
+				if log:
+					logging.error('PSQL Error: %s' % err)
+				return(0)
+			finally:
+				buf.close()
+
 	# Insert or update a row to a table
+	@trace.traced('load', 'upsert', rows=lambda status: status)
 	def upsert(self, table, row, keys):
 		table = qualify_schema(table)
 		update_where = [col + ' = %s' for col in keys]
@@ -73,6 +163,100 @@ class DB():
 		status = self.execute(sql, all_vals)
 		return(status)
 
+	# Insert or update many rows to a table in batches. Each batch is copied into a temporary staging table and
+	# merged with one UPDATE and one INSERT, rather than a statement per row. If the keys are a unique constraint on
+	# the table, on_conflict merges each batch with a single INSERT ... ON CONFLICT statement instead.
+	# The last row wins for duplicate keys. Returns a tuple of (rows inserted, rows updated)
+	@trace.traced('load', 'upsert_many', rows=sum)
+	def upsert_many(self, table, rows, keys, batch_size=10000, log=True, on_conflict=False):
+		inserted, updated = 0, 0
+		batch = collections.OrderedDict()
+		merge = self.merge_values if on_conflict else self.merge_rows
+
+		for row in rows:
+			key = tuple([row[k] for k in keys])
+			batch.pop(key, None)
+			batch[key] = row
+			if len(batch) >= batch_size:
+				ins, upd = merge(table, batch.values(), keys, log)
+				inserted += ins
+				updated += upd
+				batch = collections.OrderedDict()
+
+		if len(batch) > 0:
+			ins, upd = merge(table, batch.values(), keys, log)
+			inserted += ins
+			updated += upd
+
+		return(inserted, updated)
+
+	# Merge a single batch of rows with distinct keys into a table via a staging table. Returns (inserted, updated)
+	@trace.traced('load', 'merge_rows', rows=sum)
+	def merge_rows(self, table, rows, keys, log=True):
+		table = qualify_schema(table)
+		stage = 'pg_temp.stage_%s' % table.split('.')[-1] # Qualified so that qualify_schema leaves it in pg_temp
+		columns = rows[0].keys()
+
+		join = ' AND '.join(['tgt.%s = stg.%s' % (key, key) for key in keys])
+		update_set = ', '.join(['%s = stg.%s' % (col, col) for col in columns])
+
+		try:
+			self.cursor.execute('SAVEPOINT merge_batch;')
+			self.cursor.execute('DROP TABLE IF EXISTS %s;' % stage)
+			self.cursor.execute('CREATE TEMP TABLE %s AS SELECT %s FROM %s WITH NO DATA;' % (stage, ', '.join(columns), table))
+			if not self.copy_rows(stage, columns, rows, log):
+				raise psycopg2.DataError('Could not stage rows for %s.' % table)
+
+			sql = 'UPDATE %s AS tgt SET %s FROM %s AS stg WHERE %s;' % (table, update_set, stage, join)
+			trace.add(statements=2) # The update and insert, not counting the staging statements
+			self.cursor.execute(sql)
+			updated = self.cursor.rowcount
+
+			sql = 'INSERT INTO %s (%s) SELECT %s FROM %s AS stg ' % (table, ', '.join(columns), ', '.join(['stg.%s' % col for col in columns]), stage)
+			sql += 'WHERE NOT EXISTS (SELECT 1 FROM %s AS tgt WHERE %s);' % (table, join)
+			self.cursor.execute(sql)
+			inserted = self.cursor.rowcount
+
+			self.cursor.execute('DROP TABLE %s;' % stage)
+			self.cursor.execute('RELEASE SAVEPOINT merge_batch;')
+			return(inserted, updated)
+		except Exception as err:
+			self.cursor.execute('ROLLBACK TO SAVEPOINT merge_batch;')
+			if log:
+				logging.error('PSQL Error: %s' % err)
+			return(0, 0)
+
+	# Merge a single batch of rows with distinct keys into a table with one INSERT ... ON CONFLICT statement.
+	# Returns (inserted, updated)
+	@trace.traced('load', 'merge_values', rows=sum)
+	def merge_values(self, table, rows, keys, log=True):
+		table = qualify_schema(table)
+		columns = rows[0].keys()
+		placeholders = '(%s)' % ', '.join(['%s' for col in columns])
+		values = ', '.join([self.cursor.mogrify(placeholders, [row[col] for col in columns]) for row in rows])
+		update_set = ', '.join(['%s = EXCLUDED.%s' % (col, col) for col in columns if col not in keys])
+
+		sql = 'INSERT INTO %s AS tgt (%s) VALUES %s ' % (table, ', '.join(columns), values)
+		if len(update_set) > 0:
+			sql += 'ON CONFLICT (%s) DO UPDATE SET %s ' % (', '.join(keys), update_set)
+		else:
+			sql += 'ON CONFLICT (%s) DO NOTHING ' % ', '.join(keys)
+		sql += 'RETURNING (tgt.xmax = 0) AS inserted;' # Inserted rows have no deleting transaction
+
+		try:
+			self.cursor.execute('SAVEPOINT merge_batch;')
+			trace.add(bytes=len(sql), statements=1)
+			self.cursor.execute(sql)
+			results = [result[0] for result in self.cursor.fetchall()]
+			self.cursor.execute('RELEASE SAVEPOINT merge_batch;')
+			inserted = results.count(True)
+			return(inserted, len(results) - inserted)
+		except Exception as err:
+			self.cursor.execute('ROLLBACK TO SAVEPOINT merge_batch;')
+			if log:
+				logging.error('PSQL Error: %s' % err)
+			return(0, 0)
+
 	# Update values on a table based on a filter
 	def update(self, table, update_row, filter_row):
 		table = qualify_schema(table)
@@ -102,6 +286,14 @@ class DB():
 		status = self.execute(sql, filter_vals)
 		return(status)
 
+	# Delete from table where a column is between two values, inclusive
+	def delete_range(self, table, column, low, high):
+		sql = 'DELETE FROM %s ' % qualify_schema(table)
+		sql += 'WHERE %s BETWEEN %%s AND %%s;' % column
+
+		status = self.execute(sql, [low, high])
+		return(status)
+
 	# Update columns based on a lookup of another table
 	def lookup(self, drv_table, lkp_table, drv_keys, lkp_keys, drv_update, lkp_update, only_nulls=True):
 		# Qualify column names
@@ -131,8 +323,7 @@ class DB():
 
 	# Load CSV file into table, gets column names from CSV header
 	def load_csv(self, table, csv_file):
-		with open(csv_file, 'rb') as file:
-			reader = csv.reader(file)
+		def csv_rows(reader):
 			i = 0
 			for row in reader:
 				if i == 0:
@@ -146,30 +337,271 @@ class DB():
 						rec[columns[j]] = val
 						j += 1
 					if (len(rec) > 0):
-						self.insert(qualify_schema(table), rec)
+						yield rec
 				i += 1
 
+		with open(csv_file, 'rb') as file:
+			success, failed = self.insert_many(table, csv_rows(csv.reader(file)))
+		return(success, failed)
+
 	# Query and retrieve the records
 	def query(self, sql, vals=[]):
-		results = []
 		self.execute(sql, vals)
 		columns = [desc.name for desc in self.cursor.description]
+		results = [dict(zip(columns, result)) for result in self.cursor]
+		return(results)
 
-		# Loop through results
-		for result in self.cursor.fetchall():
-			rec = {}
-			for x in xrange(len(result)):
-				rec[columns[x]] = result[x]
-			results.append(rec)
+	# Query and iterate over the records using a server-side cursor, fetching itersize rows at a time so that
+	# large results are read in bounded memory. Rows are yielded as named tuples sharing one set of column names.
+	# Errors roll back the transaction and are raised, so that a failed query is not mistaken for an empty result
+	def stream(self, sql, vals=[], itersize=2000, log=True):
+		self.stream_count = getattr(self, 'stream_count', 0) + 1
+		cursor = self.conn.cursor(name='stream_%s' % self.stream_count)
+		try:
+			cursor.execute(sql, vals)
+			rows = cursor.fetchmany(itersize)
+			Row = collections.namedtuple('Row', [desc.name for desc in cursor.description], rename=True)
+			while len(rows) > 0:
+				for row in rows:
+					yield Row._make(row)
+				rows = cursor.fetchmany(itersize)
+		except psycopg2.Error as err:
+			self.conn.rollback()
+			if log:
+				logging.error('PSQL Error: %s' % err)
+			raise
+		finally:
+			if not cursor.closed:
+				try:
+					cursor.close()
+				except psycopg2.Error:
+					pass # Already closed by the rollback
+
+	# Derive daily deltas for a batch of snapshot records against their previous totals, read in one query from
+	# prev_table (optionally filtered, e.g. to yesterday's date_id) and matched on keys. deltas maps each delta column
+	# to its total column. Records without previous totals get deltas of 0. A failed read of the previous totals is
+	# raised, failing the job rather than writing zero deltas
+	def snapshot_deltas(self, recs, prev_table, keys, deltas, prev_filter={}):
+		total_cols = list(set(deltas.values()))
+		sql = 'SELECT %s FROM %s' % (', '.join(keys + total_cols), qualify_schema(prev_table))
+		if len(prev_filter) > 0:
+			sql += ' WHERE %s' % ' AND '.join([key + ' = %s' for key in prev_filter.keys()])
+		sql += ';'
 
-		return(results)
+		previous = {}
+		try:
+			for row in self.stream(sql, prev_filter.values()):
+				previous[tuple(row[:len(keys)])] = dict(zip(total_cols, row[len(keys):]))
+		except psycopg2.Error:
+			logging.error('Could not read previous totals from %s.' % prev_table)
+			raise
+
+		for rec in recs:
+			prev = previous.get(tuple([rec[key] for key in keys]))
+			for delta, total in deltas.items():
+				if prev is None or prev[total] is None:
+					rec[delta] = 0
+				else:
+					rec[delta] = int(rec[total]) - int(prev[total])
+		return(recs)
 
 	# Close the cursor and connection. Commit by default
 	def close(self, commit=True):
-		if commit:
-			self.conn.commit()
-		self.cursor.close()
-		self.conn.close()
+		try:
+			if commit:
+				self.conn.commit()
+			else:
+				self.conn.rollback()
+		finally:
+			# Always give the connection back, or a failed commit would hold its pool slot for good
+			try:
+				self.cursor.close()
+			finally:
+				if self.pool is None:
+					self.conn.close()
+				else:
+					self.pool.putconn(self.conn)
+					with SESSIONS_LOCK:
+						sessions = SESSIONS.get(self.thread, [])
+						if self in sessions:
+							sessions.remove(self)
+						if self.thread in SESSIONS and len(sessions) == 0:
+							del SESSIONS[self.thread]
+
+# Gets the shared connection pool. Connections set the default schema when opened rather than per session
+def get_pool():
+	global POOL
+	with POOL_LOCK:
+		if POOL is None:
+			psql_db = lyf.get_config('POSTGRESQL', 'Database')
+			psql_user = lyf.get_config('POSTGRESQL', 'Username')
+			psql_schema = lyf.get_config('POSTGRESQL', 'Default_Schema')
+			pool_size = int(lyf.get_config('POSTGRESQL', 'Pool_Size', 4))
+
+			POOL = BlockingPool(1, pool_size, 'dbname=%s user=%s' % (psql_db, psql_user), \
+				options='-c search_path=%s' % psql_schema)
+	return(POOL)
+
+# Thread-safe connection pool that waits for a connection to be returned when all are in use, rather than raising
+class BlockingPool(psycopg2.pool.ThreadedConnectionPool):
+	# Initialiser
+	def __init__(self, minconn, maxconn, *args, **kwargs):
+		self.available = threading.BoundedSemaphore(maxconn)
+		super(BlockingPool, self).__init__(minconn, maxconn, *args, **kwargs)
+
+	# Borrow a connection, waiting if the pool is exhausted
+	def getconn(self, key=None):
+		self.available.acquire()
+		try:
+			return(super(BlockingPool, self).getconn(key))
+		except Exception:
+			self.available.release()
+			raise
+
+	# Return a connection to the pool
+	def putconn(self, conn=None, key=None, close=False):
+		try:
+			super(BlockingPool, self).putconn(conn, key, close)
+		finally:
+			self.available.release()
+
+# Close all connections in the shared pool, unless sessions are still open, as closing a connection in use would
+# break off its transaction. Returns whether the pool was closed
+def close_pool():
+	global POOL
+	with POOL_LOCK:
+		if open_sessions() > 0:
+			return(False)
+		if POOL is not None:
+			POOL.closeall()
+			POOL = None
+	return(True)
+
+# Gets the number of pooled sessions open on all threads
+def open_sessions():
+	with SESSIONS_LOCK:
+		return(sum([len(sessions) for sessions in SESSIONS.values()]))
+
+# Cancel the work of a thread, e.g. a job which has overrun. The running statement of each of its pooled sessions is
+# cancelled and the connection closed, so that the thread's next statement fails, and it cannot open new sessions
+# until uncancel_thread is called
+def cancel_thread(thread):
+	with SESSIONS_LOCK:
+		CANCELLED.add(thread)
+		sessions = list(SESSIONS.get(thread, []))
+	for db in sessions:
+		try:
+			db.conn.cancel()
+			db.conn.close()
+		except psycopg2.Error as err:
+			logging.warning('Could not cancel PSQL session: %s' % err)
+
+# Allow a cancelled thread to open sessions again, e.g. when a worker thread starts its next job
+def uncancel_thread(thread):
+	with SESSIONS_LOCK:
+		CANCELLED.discard(thread)
+
+# Borrow a connection from the pool, replacing any that fail a health check
+def checkout(pool, retries=3):
+	for attempt in xrange(retries):
+		conn = pool.getconn()
+		try:
+			cursor = conn.cursor()
+			cursor.execute('SELECT 1;')
+			cursor.close()
+			conn.rollback()
+			return(conn)
+		except psycopg2.Error as err:
+			logging.warning('Discarding broken PSQL connection: %s' % err)
+			pool.putconn(conn, close=True)
+	raise psycopg2.OperationalError('Could not get a healthy connection from the pool.')
+
+# Context manager for a pooled database session. Commits on success and rolls back if an exception is raised.
+# Each thread should use its own session
+@contextlib.contextmanager
+def session():
+	db = DB(pooled=True)
+	try:
+		yield db
+	except Exception:
+		db.close(commit=False)
+		raise
+	db.close()
+
+# Cache of natural key to surrogate key lookups for a dimension table. By default the whole dimension is preloaded
+# with one query, and keys added to it since are fetched on demand; with a max_size, every key is fetched on demand
+# and the least recently used are evicted.
+# Unset values and keys not found in the dimension resolve to -1. A failed preload or lookup is raised rather than
+# resolved to -1, as the lookup's rollback has discarded the rows loaded so far in the transaction
+class DimCache():
+	# Initialiser
+	def __init__(self, db, table, natural_key, surrogate_key, max_size=None):
+		self.db = db
+		self.table = qualify_schema(table)
+		self.natural_key = natural_key
+		self.surrogate_key = surrogate_key
+		self.max_size = max_size
+		self.keys = collections.OrderedDict()
+
+		if max_size is None:
+			sql = 'SELECT %s, %s FROM %s;' % (natural_key, surrogate_key, self.table)
+			for natural, surrogate in self.db.stream(sql):
+				self.keys[natural] = surrogate
+
+	# Get the surrogate key for a single natural key value
+	def get(self, val):
+		return(self.resolve([val])[0])
+
+	# Get the surrogate keys for a list of natural key values, fetching any uncached values in one query. The cached
+	# keys are taken before the fetched ones are added, as adding them may evict keys this call needs
+	def resolve(self, vals):
+		known = {}
+		for val in set(vals):
+			if val in self.keys:
+				key = self.keys.pop(val) # Move to most recently used
+				self.keys[val] = key
+				known[val] = key
+
+		missing = [val for val in set(vals) if val not in known and val not in (None, '(not set)')]
+		if len(missing) > 0:
+			sql = 'SELECT %s, %s FROM %s WHERE %s = ANY(%%s);' % (self.natural_key, self.surrogate_key, self.table, self.natural_key)
+			if not self.db.execute(sql, [missing]):
+				raise psycopg2.DatabaseError('Could not look up keys in %s.' % self.table)
+			found = dict(self.db.cursor.fetchall())
+			for val in missing:
+				known[val] = found.get(val, -1)
+			for val in missing:
+				self.add(val, known[val])
+
+		out = []
+		for val in vals:
+			if val in (None, '(not set)'):
+				out.append(-1)
+			else:
+				out.append(known[val])
+		return(out)
+
+	# Add a lookup to the cache, evicting the least recently used entry if full
+	def add(self, val, key):
+		self.keys.pop(val, None)
+		self.keys[val] = key
+		if self.max_size is not None:
+			while len(self.keys) > self.max_size:
+				self.keys.popitem(last=False)
+
+# Formats a value for the COPY text format, escaping delimiters and mapping None to NULL. Floats use repr, as str
+# rounds them to 12 significant digits
+def copy_value(val):
+	if val is None:
+		return('\\N')
+	if isinstance(val, unicode):
+		val = val.encode('utf-8')
+	elif isinstance(val, float):
+		val = repr(val)
+	elif not isinstance(val, str):
+		val = str(val)
+	val = val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+	return(val)
 
 # Adds the default schema name to the table if not already present
 def qualify_schema(table) :
@@ -177,11 +609,69 @@ def qualify_schema(table) :
 		table = '%s.%s' % (lyf.get_config('POSTGRESQL', 'Default_Schema'), table)
 	return(table)
 
-# Load Google Analytics dimension table
-def load_ga_dim(full_mode, table, ga_dims, columns, keys):
-	try:
-		end_date = date.today().strftime('%Y-%m-%d') # Fetch up to today
-		db = DB() # Connect to DB
+# Gets the last complete date loaded into a table, or None if it has never been loaded
+def get_watermark(db, table):
+	results = db.query('SELECT last_date FROM etl_watermark WHERE table_name = %s;', [table])
+	if len(results) == 0:
+		return(None)
+	return(results[0]['last_date'])
+
+# Records the last complete date loaded into a table, given the end of the range extracted. Today is still in
+# progress, so by default the watermark stops at yesterday and the next run loads today again
+def set_watermark(db, table, end_date, until_yesterday=True):
+	from dateutil.parser import parse	# Date parser
+
+	last_date = parse(end_date).date()
+	if until_yesterday:
+		last_date = min(last_date, date.today() - timedelta(days=1))
+	rec = { 'table_name' : table, 'last_date' : last_date, 'updated' : datetime.now() }
+	return(db.upsert('etl_watermark', rec, ['table_name']))
+
+# Removes the watermark for a table
+def clear_watermark(db, table):
+	return(db.delete('etl_watermark', { 'table_name' : table }))
+
+# Gets the date range for an incremental load of a table, from the day after its watermark up to today.
+# Tables without a watermark load just today. Returns a tuple of (start date, end date) strings
+def incremental_dates(db, table):
+	today = date.today()
+	start = today
+	watermark = get_watermark(db, table)
+	if watermark is not None:
+		start = min(watermark + timedelta(days=1), today)
+	return(start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
+
+# Create an empty copy of a table, with the same columns, defaults and indexes, to load in the background
+def create_shadow(db, table, shadow):
+	db.execute('DROP TABLE IF EXISTS %s;' % qualify_schema(shadow))
+	return(db.execute('CREATE TABLE %s (LIKE %s INCLUDING ALL);' % (qualify_schema(shadow), qualify_schema(table))))
+
+# Atomically replace a table with its shadow copy, dropping the old table
+def swap_shadow(db, table, shadow):
+	name = qualify_schema(table).split('.')[-1]
+	sql = 'ALTER TABLE %s RENAME TO %s_old; ' % (qualify_schema(table), name)
+	sql += 'ALTER TABLE %s RENAME TO %s; ' % (qualify_schema(shadow), name)
+	sql += 'DROP TABLE %s_old;' % qualify_schema(table)
+	return(db.execute(sql, commit=True))
+
+# Reload the generic country table from data/countries.csv
+def reload_countries(db):
+	countries_file = os.path.join(lyf.SCRIPT_DIR, 'data', 'countries.csv')
+	db.truncate('d_country')
+	db.reset_seq('d_country', 'country_id')
+	return(db.load_csv('d_country', countries_file))
+
+# Merges pages of Google Analytics rows into a dimension table as they are extracted. Full mode empties the table
+# down to its -1 row first. The watermark is only moved on if every page merged
+class GA_DimLoader():
+	# Initialiser
+	def __init__(self, db, full_mode, table, columns, keys):
+		self.db = db
+		self.full_mode = full_mode
+		self.table = table
+		self.columns = columns
+		self.keys = keys
+		self.merged, self.rows, self.failed = 0, 0, False
 
 		if full_mode:
 			db.truncate(table) # Truncate table
@@ -196,31 +686,126 @@ def load_ga_dim(full_mode, table, ga_dims, columns, keys):
 			db.insert(table, rec)
 			db.conn.commit()
 
-			start_date = lyf.get_config('ETL', 'Extract_Date')
-		else:
-			start_date = end_date
-
-		# Connect to Google Analytics
-		service = lyf.google_api('analytics', 'v3', ['https://www.googleapis.com/auth/analytics.readonly'])
-		metrics = 'ga:sessions'
-		dims = ','.join(ga_dims)
-		results = lyf.ga_query(service, start_date, end_date, metrics, dims)
-
-		inserts = 0
-		for row in results:
-			rec = {}
-			i = 0
-			for key in columns:
-				rec[key] = row[i]
-				i += 1
-			inserts += db.upsert(table, rec, keys)
-
-		db.close()
-
-		if full_mode:
+	# Merge a page of rows, in the order of the columns
+	def merge(self, page):
+		with trace.span('transform', 'ga_dim', rows=len(page)):
+			recs = []
+			for row in page:
+				rec = {}
+				i = 0
+				for key in self.columns:
+					rec[key] = row[i]
+					i += 1
+				recs.append(rec)
+
+		inserted, updated = self.db.upsert_many(self.table, recs, self.keys)
+		self.merged += inserted + updated
+		self.rows += len(page)
+		if inserted + updated < len(set([tuple([rec[key] for key in self.keys]) for rec in recs])):
+			self.failed = True # A batch was rolled back
+
+	# Move the watermark on to end_date if every page merged. Returns a summary of the load
+	def finish(self, end_date):
+		summary = { 'table' : self.table, 'merged' : self.merged, 'rows' : self.rows, 'error' : None }
+		if self.failed:
+			summary['error'] = 'Some batches failed to merge into %s.' % self.table
+		elif not set_watermark(self.db, self.table, end_date):
+			summary['error'] = 'Failed to set the watermark of %s.' % self.table
+
+		if self.full_mode:
 			mode = 'Full'
 		else:
 			mode = 'Incremental'
-		logging.info('Merged %s/%s rows into %s (%s).' % (inserts, len(results), table, mode))
+		logging.info('Merged %s/%s rows into %s (%s).' % (self.merged, self.rows, self.table, mode))
+		if summary['error'] is not None:
+			logging.error(summary['error'])
+		return(summary)
+
+# Load Google Analytics dimension table
+# Full mode extracts are split into date shards fetched concurrently by a number of workers, whereas incremental
+# mode extracts the dates since the table's watermark.
+# Returns a summary of the load. Safe to call from worker threads, each using its own connection and GA service
+def load_ga_dim(full_mode, table, ga_dims, columns, keys, shard='month', workers=4):
+	summary = { 'table' : table, 'merged' : 0, 'rows' : 0, 'error' : None }
+	try:
+		end_date = date.today().strftime('%Y-%m-%d') # Fetch up to today
+		with session() as db: # Connect to DB
+			loader = GA_DimLoader(db, full_mode, table, columns, keys)
+			if full_mode:
+				start_date = lyf.get_config('ETL', 'Extract_Date')
+			else:
+				start_date, end_date = incremental_dates(db, table)
+				shard = None
+
+			# Connect to Google Analytics
+			service = ga.ga_service()
+			metrics = 'ga:sessions'
+			dims = ','.join(ga_dims)
+
+			# Merge each page while the next one downloads
+			for page in ga.iter_ga_results(service, start_date, end_date, metrics, dims, shard=shard, workers=workers):
+				loader.merge(page)
+			summary = loader.finish(end_date)
 	except Exception as err:
 		logging.error(err)
+		summary['error'] = str(err)
+	return(summary)
+
+# Gets the geo, source and page dimension caches used to load the Google Analytics fact table
+def ga_fact_caches(db, cache_size=None):
+	geo = DimCache(db, 'lyf.d_ga_geo', 'city_id', 'geo_id', cache_size)
+	source = DimCache(db, 'lyf.d_ga_source', 'source_medium', 'source_id', cache_size)
+	page = DimCache(db, 'lyf.d_ga_page', 'page_title', 'page_id', cache_size)
+	return(geo, source, page)
+
+# Load pages of Google Analytics rows for the fact dimensions and metrics into f_ga_daily, resolving surrogate keys
+# a page at a time from cached dimensions, which can be shared between calls.
+# Returns a tuple of (rows inserted, rows extracted)
+def load_ga_fact(db, pages, cache_size=None, table='f_ga_daily', caches=None):
+	if caches is None:
+		caches = ga_fact_caches(db, cache_size)
+	geo, source, page = caches
+
+	def fact_rows(results):
+		geo_ids = geo.resolve([row[1] for row in results])
+		source_ids = source.resolve([row[2] for row in results])
+		page_ids = page.resolve([row[3] for row in results])
+
+		for i, row in enumerate(results):
+			rec = {}
+			rec['date_id'] = row[0]
+			rec['geo_id'] = geo_ids[i]
+			rec['source_id'] = source_ids[i]
+			rec['page_id'] = page_ids[i]
+			rec['longitude'] = row[4]
+			rec['latitude'] = row[5]
+			rec['user_type'] = row[6]
+			rec['sessions'] = row[7]
+			rec['bounces'] = row[8]
+			rec['bounce_rate'] = row[9]
+			rec['avg_session_duration'] = row[10]
+			rec['session_duration'] = row[11]
+			rec['page_views'] = row[12]
+			rec['time_on_page'] = row[13]
+			yield rec
+
+	# Load each page while the next one downloads
+	success, total = 0, 0
+	for results in pages:
+		with trace.span('transform', 'ga_fact', rows=len(results)):
+			recs = list(fact_rows(results))
+		inserted, failed = db.insert_many(table, recs)
+		success += inserted
+		total += len(results)
+	return(success, total)
+
+# Update the page table with blog type and author details from Google Analytics rows. Returns the number updated
+def update_ga_blog(db, rows):
+	updated_pages = 0
+	for row in rows:
+		rec = { 'page_type' : row[1], 'author' : row[2] }
+		filter_rec = { 'page_title' : row[0] }
+		status = db.update('d_ga_page', rec, filter_rec)
+		if status == 1:
+			updated_pages += 1
+	return(updated_pages)
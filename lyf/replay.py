@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+# Record and replay API traffic, so the extractors can run offline against saved or synthetic responses
+
+import lyf, logging
+import os
+import re
+import json
+import time
+import hashlib
+import urlparse
+import requests
+import httplib2
+
+# Modes set by REPLAY Mode: record live responses to disk, replay them from disk, or send every request to a stand-in
+# API server (see api_standin.py) instead of the real host
+global REPLAY_MODES, SECRET_PARAMS
+REPLAY_MODES = ['record', 'replay', 'server']
+SECRET_PARAMS = ['access_token', 'client_id', 'client_secret', 'fb_exchange_token', 'key']
+SECRET_PATTERNS = [
+	(re.compile(r'(access_token|client_secret|fb_exchange_token)=[^&"\s]+'), r'\1=REDACTED'),
+	(re.compile(r'("access_token"\s*:\s*)"[^"]*"'), r'\1"REDACTED"')
+]
+
+# Gets the configured replay mode, or None when requests go to the live APIs
+def replay_mode():
+	mode = lyf.get_config('REPLAY', 'Mode', '').lower()
+	if mode == '':
+		return(None)
+	if mode not in REPLAY_MODES:
+		raise ValueError('Unknown replay mode: %s' % mode)
+	return(mode)
+
+# Directory holding recorded responses, relative to the scripts
+def replay_dir():
+	return(os.path.join(lyf.SCRIPT_DIR, lyf.get_config('REPLAY', 'Dir', 'cassettes')))
+
+# Key identifying a request, ignoring the order of parameters and any credentials in the URL or form body
+def request_key(method, url, body=None):
+	parts = urlparse.urlsplit(url)
+	query = sorted([(k, v) for k, v in urlparse.parse_qsl(parts.query, True) if k not in SECRET_PARAMS])
+	form = []
+	if body:
+		form = sorted([(k, v) for k, v in urlparse.parse_qsl(body, True) if k not in SECRET_PARAMS])
+	key = json.dumps([method.upper(), parts.hostname, parts.path, query, form])
+	return(hashlib.sha1(key).hexdigest())
+
+# Remove access tokens and secrets from recorded text
+def scrub(text):
+	for pattern, replace in SECRET_PATTERNS:
+		text = pattern.sub(replace, text)
+	return(text)
+
+# Path of the recording for a request, grouped by host
+def cassette_path(method, url, body=None, directory=None):
+	host = urlparse.urlsplit(url).hostname
+	return(os.path.join(directory or replay_dir(), host, '%s.json' % request_key(method, url, body)))
+
+# Save a response to disk. Headers are kept so rate limit and paging behaviour can be replayed
+def save_cassette(method, url, body, status, headers, content):
+	path = cassette_path(method, url, body)
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+
+	record = {
+		'method' : method.upper(),
+		'url' : scrub(url),
+		'status' : status,
+		'headers' : dict([(k, v) for k, v in headers.items() if k.lower() not in ['set-cookie', 'content-encoding']]),
+		'body' : scrub(content.decode('utf-8'))
+	}
+	tmp_file = '%s.tmp' % path
+	with open(tmp_file, 'w') as f:
+		json.dump(record, f, indent=2, sort_keys=True)
+	os.rename(tmp_file, path)
+
+# Load a recorded response, raising an error if the request was never recorded
+def load_cassette(method, url, body=None, directory=None):
+	path = cassette_path(method, url, body, directory)
+	if not os.path.exists(path):
+		raise IOError('No recording for %s %s at %s.' % (method.upper(), scrub(url), path))
+	with open(path) as f:
+		return(json.load(f))
+
+# Rewrite a URL to the stand-in server, which takes the original host as the first part of the path
+def server_url(url):
+	parts = urlparse.urlsplit(url)
+	server = lyf.get_config('REPLAY', 'Server', 'http://127.0.0.1:8808').rstrip('/')
+	return('%s/%s%s%s' % (server, parts.netloc, parts.path, '?%s' % parts.query if parts.query else ''))
+
+# Wait the configured latency before answering a replayed request, for deterministic timing
+def replay_latency():
+	latency = float(lyf.get_config('REPLAY', 'Latency', 0))
+	if latency > 0:
+		time.sleep(latency)
+
+# Class for a requests session that records, replays or redirects every request according to the replay mode
+class ReplaySession(requests.Session):
+	# Initialiser
+	def __init__(self, mode):
+		requests.Session.__init__(self)
+		self.mode = mode
+
+	# Send a prepared request
+	def send(self, request, **kwargs):
+		if self.mode == 'server':
+			request.url = server_url(request.url)
+			return(requests.Session.send(self, request, **kwargs))
+
+		if self.mode == 'replay':
+			record = load_cassette(request.method, request.url, request.body)
+			replay_latency()
+			r = requests.Response()
+			r.status_code = record['status']
+			r.headers = requests.structures.CaseInsensitiveDict(record['headers'])
+			r._content = record['body'].encode('utf-8')
+			r.encoding = 'utf-8'
+			r.url = request.url
+			r.request = request
+			return(r)
+
+		r = requests.Session.send(self, request, **kwargs)
+		save_cassette(request.method, request.url, request.body, r.status_code, r.headers, r.content)
+		return(r)
+
+# Class for an httplib2 connection used by the Google API clients, recording, replaying or redirecting like
+# ReplaySession. Discovery documents are fetched through it as well
+class ReplayHttp(httplib2.Http):
+	# Initialiser
+	def __init__(self, mode):
+		httplib2.Http.__init__(self)
+		self.mode = mode
+
+	# Send a request, returning the response headers and content
+	def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+		if self.mode == 'server':
+			return(httplib2.Http.request(self, server_url(uri), method, body, headers, redirections, connection_type))
+
+		if self.mode == 'replay':
+			record = load_cassette(method, uri, body)
+			replay_latency()
+			response = httplib2.Response(dict([(k.lower(), v) for k, v in record['headers'].items()]))
+			response.status = record['status']
+			return(response, record['body'].encode('utf-8'))
+
+		response, content = httplib2.Http.request(self, uri, method, body, headers, redirections, connection_type)
+		save_cassette(method, uri, body, response.status, response, content)
+		return(response, content)
+
+# Gets a requests session for the replay mode, or None when requests go to the live APIs
+def replay_session():
+	mode = replay_mode()
+	if mode is None:
+		return(None)
+	return(ReplaySession(mode))
+
+# Gets an httplib2 connection for the Google API clients. Only live and recorded traffic needs authorising
+def replay_http():
+	mode = replay_mode()
+	if mode is None:
+		return(httplib2.Http())
+	return(ReplayHttp(mode))
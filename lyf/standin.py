@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+# Local stand-in for the Google, Facebook and MailChimp APIs, serving recorded responses or synthetic paginated data
+
+import lyf, logging
+import re
+import json
+import time
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from datetime import date, timedelta, datetime	# Date time
+from lyf import replay	# Recorded responses
+from lyf import mailchimp	# Fields requested from MailChimp
+
+# Google API methods described by the synthetic discovery documents: (resource path, method path, parameters)
+global DISCOVERY_METHODS
+DISCOVERY_METHODS = {
+	('analytics', 'v3') : [
+		(['data', 'ga'], 'data/ga', ['ids', 'start-date', 'end-date', 'metrics'], \
+			['dimensions', 'filters', 'sort', 'segment', 'samplingLevel', 'output'], ['max-results', 'start-index'])
+	],
+	('youtube', 'v3') : [
+		(['search'], 'search', ['part'], ['channelId', 'type', 'pageToken', 'q'], ['maxResults']),
+		(['videos'], 'videos', ['part'], ['id'], ['maxResults'])
+	]
+}
+
+# Class for the settings of the synthetic data: total rows for every GA query, items in each Facebook edge, YouTube
+# channel and MailChimp collection, and the page size of Facebook edges
+class Synthetic():
+	def __init__(self, ga_rows=10000, items=100, fb_page_size=25, seed=0): # Initialiser
+		self.ga_rows = ga_rows
+		self.items = items
+		self.fb_page_size = fb_page_size
+		self.seed = seed
+
+	# Deterministic number for a row and column, so repeated runs get identical data
+	def number(self, i, j, high=1000):
+		return((i * 7919 + j * 104729 + self.seed * 15485863) % high)
+
+	# Answer a request to one of the APIs. Returns the status and JSON document, or None if the path is not known
+	def respond(self, method, host, path, query, form):
+		if host == 'www.googleapis.com':
+			match = re.match('^/discovery/v1/apis/(\w+)/(\w+)/rest$', path)
+			if match:
+				return(200, discovery_doc(match.group(1), match.group(2)))
+			if path == '/analytics/v3/data/ga':
+				return(200, self.ga_data(query))
+			if path == '/youtube/v3/search':
+				return(200, self.yt_search(query))
+			if path == '/youtube/v3/videos':
+				return(200, self.yt_videos(query))
+		elif host == 'graph.facebook.com':
+			return(self.fb_request(method, path, query, form))
+		elif host.endswith('.api.mailchimp.com'):
+			match = re.match('^/3.0/(lists|campaigns)$', path)
+			if match:
+				return(200, self.mc_collection(match.group(1), query))
+		return(None)
+
+	# Google Analytics rows, spread evenly over the requested dates and paged by start-index
+	def ga_data(self, query):
+		start_date = datetime.strptime(query['start-date'], '%Y-%m-%d').date()
+		days = (datetime.strptime(query['end-date'], '%Y-%m-%d').date() - start_date).days + 1
+		dimensions = query['dimensions'].split(',') if 'dimensions' in query else []
+		metrics = query['metrics'].split(',')
+		start_index = int(query.get('start-index', 1))
+		max_results = int(query.get('max-results', 1000))
+		total = self.ga_rows if len(dimensions) > 0 else 1
+
+		rows = []
+		for i in xrange(start_index - 1, min(total, start_index - 1 + max_results)):
+			row = []
+			for j, dim in enumerate(dimensions):
+				if dim == 'ga:date':
+					row.append((start_date + timedelta(days=i * days // total)).strftime('%Y%m%d'))
+				elif dim in ['ga:latitude', 'ga:longitude']:
+					row.append('%.4f' % (self.number(i, j, 180000) / 1000.0 - 90))
+				else:
+					row.append('%s %s' % (dim[3:], self.number(i, j, 500)))
+			row.extend([str(self.number(i, len(dimensions) + j)) for j in range(len(metrics))])
+			rows.append(row)
+
+		headers = [{ 'name' : dim, 'columnType' : 'DIMENSION' } for dim in dimensions]
+		headers += [{ 'name' : metric, 'columnType' : 'METRIC' } for metric in metrics]
+		return({
+			'query' : { 'start-index' : start_index, 'max-results' : max_results },
+			'totalResults' : total,
+			'containsSampledData' : False,
+			'columnHeaders' : headers,
+			'rows' : rows
+		})
+
+	# Search results for the channel's videos, paged with the offset as the page token
+	def yt_search(self, query):
+		offset = int(query.get('pageToken', 0))
+		limit = int(query.get('maxResults', 5))
+		results = { 'items' : [{ 'id' : { 'kind' : 'youtube#video', 'videoId' : 'video%06d' % i } } \
+			for i in xrange(offset, min(self.items, offset + limit))] }
+		if offset + limit < self.items:
+			results['nextPageToken'] = str(offset + limit)
+		return(results)
+
+	# Details and statistics for a list of videos
+	def yt_videos(self, query):
+		items = []
+		for video_id in query.get('id', '').split(','):
+			i = int(video_id[5:])
+			items.append({
+				'id' : video_id,
+				'snippet' : { 'title' : 'Video %s' % i, 'publishedAt' : '2016-01-01T00:00:00.000Z', 'channelTitle' : 'Stand-in' },
+				'statistics' : { 'viewCount' : str(self.number(i, 0, 100000)), 'likeCount' : str(self.number(i, 1)), \
+					'dislikeCount' : str(self.number(i, 2, 50)) }
+			})
+		return({ 'items' : items })
+
+	# Answer a Graph API request, running each request of a batch in turn
+	def fb_request(self, method, path, query, form):
+		parts = path.strip('/').split('/')
+		if method == 'POST' and len(parts) == 1:
+			responses = []
+			for request in json.loads(form['batch']):
+				url = urlparse.urlsplit(request['relative_url'])
+				result = self.fb_request('GET', '/%s/%s' % (parts[0], url.path), dict(urlparse.parse_qsl(url.query)), {})
+				if result is None:
+					responses.append({ 'code' : 404, 'body' : json.dumps({ 'error' : { 'message' : 'Unknown path' } }) })
+				else:
+					responses.append({ 'code' : result[0], 'body' : json.dumps(result[1]) })
+			return(200, responses)
+
+		if parts[1:] == ['oauth', 'access_token']:
+			return(200, { 'access_token' : 'standin-token', 'token_type' : 'bearer' })
+		if parts[1:] == ['me']:
+			return(200, self.fb_node(parts[0], query.get('fields', 'id')))
+		if len(parts) == 3 and parts[1] == 'me':
+			return(200, self.fb_edge(parts[0], parts[2], int(query.get('offset', 0)), self.items))
+		if len(parts) == 4 and parts[1:3] == ['me', 'insights']:
+			end_time = '%sT07:00:00+0000' % query.get('since', '2016-01-01')
+			return(200, { 'data' : [{ 'name' : metric, 'period' : query.get('period', 'day'), \
+				'values' : [{ 'value' : self.number(sum(map(ord, metric)), 0), 'end_time' : end_time }] } \
+				for metric in parts[3].split(',')] })
+		return(None)
+
+	# The page node with the requested fields. Edges filtered with since() only have the newest couple of items
+	def fb_node(self, version, fields):
+		node = {}
+		for field in split_fields(fields):
+			name = re.match('^(\w+)', field).group(1)
+			if '{' in field or name in ['posts', 'videos', 'feed']:
+				node[name] = self.fb_edge(version, name, 0, min(2, self.items) if '.since(' in field else self.items)
+			elif name == 'name':
+				node[name] = 'Stand-in Page'
+			elif name in ['id', 'access_token']:
+				node[name] = 'standin-%s' % name
+			else:
+				node[name] = self.number(len(name), 0, 100000)
+		return(node)
+
+	# A page of a Graph API edge, linking to the next page by offset
+	def fb_edge(self, version, edge, offset, total):
+		items = []
+		for i in xrange(offset, min(total, offset + self.fb_page_size)):
+			items.append({
+				'id' : '%s_%s' % (edge, i),
+				'created_time' : '2016-01-01T00:00:00+0000',
+				'message' : 'Stand-in %s %s' % (edge, i),
+				'description' : 'Stand-in %s %s' % (edge, i),
+				'likes' : { 'data' : [{ 'id' : str(j) } for j in range(self.number(i, 0, 5))] }
+			})
+		page = { 'data' : items }
+		if offset + self.fb_page_size < total:
+			page['paging'] = { 'next' : 'https://graph.facebook.com/%s/me/%s?offset=%s' % \
+				(version, edge, offset + self.fb_page_size) }
+		return(page)
+
+	# A page of MailChimp lists or campaigns, with every field used by MC_List and MC_Campaign
+	def mc_collection(self, collection, query):
+		offset = int(query.get('offset', 0))
+		count = int(query.get('count', 10))
+		items = []
+		for i in xrange(offset, min(self.items, offset + count)):
+			if collection == 'lists':
+				stats = dict([(field[6:], self.number(i, j)) for j, field in enumerate(mailchimp.MC_LIST_FIELDS) \
+					if field.startswith('stats.')])
+				stats['campaign_last_sent'] = stats['last_sub_date'] = '2016-01-01T00:00:00+00:00'
+				items.append({ 'id' : 'list%06d' % i, 'name' : 'List %s' % i, 'date_created' : '2016-01-01T00:00:00+00:00', \
+					'subscribe_url_short' : 'http://eepurl.com/%s' % i, 'stats' : stats })
+			else:
+				report = dict([(field[15:], self.number(i, j)) for j, field in enumerate(mailchimp.MC_CAMPAIGN_FIELDS) \
+					if field.startswith('report_summary.')])
+				items.append({ 'id' : 'campaign%06d' % i, 'settings' : { 'title' : 'Campaign %s' % i, \
+					'subject_line' : 'Subject %s' % i }, 'create_time' : '2016-01-01T00:00:00+00:00', \
+					'emails_sent' : self.number(i, 0, 100000), 'report_summary' : report })
+		return({ collection : items, 'total_items' : self.items })
+
+# Split a Graph API fields expression on the commas outside of any braces or brackets
+def split_fields(fields):
+	parts, depth, current = [], 0, ''
+	for char in fields:
+		if char in '{(':
+			depth += 1
+		elif char in '})':
+			depth -= 1
+		if char == ',' and depth == 0:
+			parts.append(current)
+			current = ''
+		else:
+			current += char
+	if current != '':
+		parts.append(current)
+	return(parts)
+
+# Minimal discovery document for a Google API, describing only the methods used by the extractors
+def discovery_doc(api, version):
+	resources = {}
+	for resource_path, path, required, optional, integers in DISCOVERY_METHODS[(api, version)]:
+		parameters = {}
+		for name in required + optional:
+			parameters[name] = { 'type' : 'string', 'location' : 'query', 'required' : name in required }
+		for name in integers:
+			parameters[name] = { 'type' : 'integer', 'location' : 'query' }
+
+		node = resources
+		for name in resource_path[:-1]:
+			node = node.setdefault(name, {}).setdefault('resources', {})
+		node[resource_path[-1]] = { 'methods' : { ('get' if api == 'analytics' else 'list') : {
+			'id' : '%s.%s' % (api, '.'.join(resource_path)),
+			'path' : path,
+			'httpMethod' : 'GET',
+			'parameters' : parameters,
+			'parameterOrder' : required
+		} } }
+
+	return({
+		'kind' : 'discovery#restDescription',
+		'discoveryVersion' : 'v1',
+		'id' : '%s:%s' % (api, version),
+		'name' : api,
+		'version' : version,
+		'protocol' : 'rest',
+		'rootUrl' : 'https://www.googleapis.com/',
+		'servicePath' : '%s/%s/' % (api, version),
+		'baseUrl' : 'https://www.googleapis.com/%s/%s/' % (api, version),
+		'parameters' : {},
+		'schemas' : {},
+		'resources' : resources
+	})
+
+# Handler taking the original host as the first part of the path, e.g. /graph.facebook.com/v2.8/me
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1' # Keep connections alive, like the real APIs
+
+	def do_GET(self):
+		self.respond('GET')
+
+	def do_POST(self):
+		self.respond('POST')
+
+	# Serve a recorded response if there is one, otherwise synthetic data
+	def respond(self, method):
+		length = int(self.headers.get('Content-Length', 0))
+		body = self.rfile.read(length) if length > 0 else None
+		host, path = (self.path.lstrip('/').split('/', 1) + [''])[:2]
+		url = 'https://%s/%s' % (host, path)
+		parts = urlparse.urlsplit(url)
+
+		if self.server.latency > 0:
+			time.sleep(self.server.latency)
+
+		try:
+			record = replay.load_cassette(method, url, body, self.server.directory)
+			status, content, headers = record['status'], record['body'].encode('utf-8'), record['headers']
+		except IOError:
+			result = None
+			if self.server.synthetic is not None:
+				query = dict(urlparse.parse_qsl(parts.query, True))
+				form = dict(urlparse.parse_qsl(body or '', True))
+				result = self.server.synthetic.respond(method, parts.hostname, parts.path, query, form)
+			if result is None:
+				result = (404, { 'error' : { 'code' : 404, 'message' : 'No recording or synthetic data for %s' % url } })
+			status, content, headers = result[0], json.dumps(result[1]), {}
+
+		self.send_response(status)
+		for header, value in headers.items():
+			if header.lower() not in ['status', 'content-length', 'transfer-encoding', 'connection']:
+				self.send_header(header, value)
+		self.send_header('Content-Type', 'application/json; charset=UTF-8')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, format, *args):
+		logging.debug(format % args)
+
+# Class for the stand-in server, answering each request on its own thread
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	# Initialiser. Responses are delayed by latency seconds; without synthetic settings unrecorded requests get a 404
+	def __init__(self, port, directory=None, synthetic=None, latency=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+		self.directory = directory or replay.replay_dir()
+		self.synthetic = synthetic
+		self.latency = latency
+
+# Start a stand-in server on a background thread, returning it so it can be shut down
+def start_server(port=8808, directory=None, synthetic=None, latency=0):
+	server = StandinServer(port, directory, synthetic, latency)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return(server)
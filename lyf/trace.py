@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# Lightweight tracing of the extract, transform and load stages, exportable as JSON or in Prometheus text format
+
+import lyf, logging
+import os
+import time
+import threading
+import functools
+
+# Counts kept for every span, as well as its duration
+global TRACE_COUNTS
+TRACE_COUNTS = ['rows', 'bytes', 'statements', 'requests', 'errors']
+
+TRACE_STATS = {}
+TRACE_HOOKS = []
+TRACE_LOCK = threading.Lock()
+TRACE_DATA = threading.local()
+
+# Class for a timed span of work within a stage, e.g. ('extract', 'ga_page') or ('load', 'copy'). Used as a context
+# manager; counts added while it is open are also added to any spans open around it on the same thread
+class Span():
+	# Initialiser
+	def __init__(self, stage, name, **counts):
+		self.stage = stage
+		self.name = name
+		self.counts = dict([(count, counts.get(count, 0)) for count in TRACE_COUNTS])
+		self.start = None
+
+	def __enter__(self):
+		if not hasattr(TRACE_DATA, 'spans'):
+			TRACE_DATA.spans = []
+		TRACE_DATA.spans.append(self)
+		self.start = time.time()
+		return(self)
+
+	def __exit__(self, err_type, err, tb):
+		seconds = time.time() - self.start
+		TRACE_DATA.spans.remove(self)
+		if err_type is not None:
+			self.counts['errors'] += 1
+		record(self.stage, self.name, seconds, **self.counts)
+		return(False)
+
+	# Add to the counts of this span
+	def add(self, **counts):
+		for count, value in counts.items():
+			self.counts[count] += value
+
+# Start a span for a stage
+def span(stage, name, **counts):
+	return(Span(stage, name, **counts))
+
+# Decorator tracing every call of a function as a span. If given, rows is called with the function's result to get
+# the number of rows it processed
+def traced(stage, name, rows=None):
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with span(stage, name) as open_span:
+				result = func(*args, **kwargs)
+				if rows is not None:
+					open_span.add(rows=rows(result))
+				return(result)
+		return(wrapper)
+	return(decorator)
+
+# Add to the counts of every span open on this thread, e.g. the bytes of a response or a statement executed
+def add(**counts):
+	for open_span in getattr(TRACE_DATA, 'spans', []):
+		open_span.add(**counts)
+
+# Record a finished span, calling any hooks with its stage, name, duration and counts
+def record(stage, name, seconds, **counts):
+	with TRACE_LOCK:
+		stats = TRACE_STATS.setdefault((stage, name), dict([(count, 0) for count in ['spans', 'seconds'] + TRACE_COUNTS]))
+		stats['spans'] += 1
+		stats['seconds'] += seconds
+		for count, value in counts.items():
+			stats[count] += value
+		hooks = list(TRACE_HOOKS)
+
+	for hook in hooks:
+		try:
+			hook(stage, name, seconds, counts)
+		except Exception as err:
+			logging.error('Trace hook failed: %s' % err)
+
+# Call a function with the stage, name, duration in seconds and counts of every finished span
+def add_hook(func):
+	with TRACE_LOCK:
+		TRACE_HOOKS.append(func)
+
+# Clear everything recorded so far
+def reset():
+	with TRACE_LOCK:
+		TRACE_STATS.clear()
+
+# Gets the totals for each stage and span name, with the API request metrics for each host
+def report():
+	with TRACE_LOCK:
+		stages = {}
+		for (stage, name), stats in TRACE_STATS.items():
+			stages.setdefault(stage, {})[name] = dict(stats)
+	for stage in stages.values():
+		for stats in stage.values():
+			stats['seconds'] = round(stats['seconds'], 3)
+	return({ 'stages' : stages, 'api' : lyf.api_stats() })
+
+# Escape a Prometheus label value
+def label(value):
+	return(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+# Gets everything recorded in Prometheus text format, with a counter for each count of each stage and span name
+def prometheus(prefix='lyf'):
+	totals = report()
+	lines = []
+
+	metrics = [('spans', 'Spans finished'), ('seconds', 'Seconds spent in spans')]
+	metrics += [(count, '%s counted in spans' % count.capitalize()) for count in TRACE_COUNTS]
+	for count, help_text in metrics:
+		metric = '%s_stage_%s_total' % (prefix, count)
+		lines.append('# HELP %s %s, by stage and name.' % (metric, help_text))
+		lines.append('# TYPE %s counter' % metric)
+		for stage, names in sorted(totals['stages'].items()):
+			for name, stats in sorted(names.items()):
+				lines.append('%s{stage="%s",name="%s"} %s' % (metric, label(stage), label(name), stats[count]))
+
+	for count in ['requests', 'retries', 'wait_seconds']:
+		metric = '%s_api_%s_total' % (prefix, count)
+		lines.append('# HELP %s API %s, by host.' % (metric, count.replace('_', ' ')))
+		lines.append('# TYPE %s counter' % metric)
+		for host, stats in sorted(totals['api'].items()):
+			lines.append('%s{host="%s"} %s' % (metric, label(host), round(stats[count], 3)))
+	return('\n'.join(lines) + '\n')
+
+# Write the Prometheus text to a file atomically, e.g. for the node exporter's textfile collector
+def write_prometheus(path, prefix='lyf'):
+	tmp_file = '%s.tmp' % path
+	with open(tmp_file, 'w') as f:
+		f.write(prometheus(prefix))
+	os.rename(tmp_file, path)
@@ -0,0 +1,18 @@
+#! /usr/bin/env python
+# Twitter extraction. tweepy is imported on first use, so importing this module is cheap
+
+import lyf, logging
+
+# Connects to Twitter API and returns the service object
+def twitter_api():
+	consumer_key = lyf.get_config('TWITTER', 'Consumer_Key')
+	consumer_secret = lyf.get_config('TWITTER', 'Consumer_Secret')
+	access_token = lyf.get_config('TWITTER', 'Access_Token')
+	access_token_secret = lyf.get_config('TWITTER', 'Access_Token_Secret')
+
+	import tweepy	# Twitter client, only loaded when Twitter is used
+
+	auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+	auth.set_access_token(access_token, access_token_secret)
+	api = tweepy.API(auth)
+	return(api)
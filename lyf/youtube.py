@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# YouTube extraction, through the Google API client set up by lyf.ga
+
+import lyf, logging
+
+from lyf import ga	# Google API services and request execution
+from lyf import trace	# Stage timings and counts
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent API calls
+
+# YouTube
+global YT_SCOPES
+YT_SCOPES = ['https://www.googleapis.com/auth/youtube']
+
+# Class for youtube videos
+class YT_Video():
+	def __init__(self, id, name, publish_date, channel, views=0, likes=0, dislikes=0): # Initialiser
+		from dateutil.parser import parse	# Date parser
+
+		self.id = id
+		self.name = name
+		self.publish_date = parse(publish_date)
+		self.channel = channel
+		self.views = int(views)
+		self.likes = int(likes)
+		self.dislikes = int(dislikes)
+
+# Gets the shared YouTube service
+def yt_service():
+	return(ga.google_api('youtube', 'v3', YT_SCOPES))
+
+# Get details and statistics for a list of YouTube video IDs
+def fetch_yt_videos(video_ids):
+	with trace.span('extract', 'yt_videos') as span:
+		video_response = ga.ga_execute(yt_service().videos().list(
+			id=','.join(video_ids),
+			part='snippet,statistics'
+		))
+		span.add(rows=len(video_response.get('items', [])))
+
+	videos = []
+	for item in video_response.get('items', []):
+		id = item['id']
+		title = item['snippet']['title']
+		publish_date = item['snippet']['publishedAt']
+		channel = item['snippet']['channelTitle']
+		views = item['statistics'].get('viewCount', 0)
+		likes = item['statistics'].get('likeCount', 0)
+		dislikes = item['statistics'].get('dislikeCount', 0)
+		video = YT_Video(id, title, publish_date, channel, views, likes, dislikes)
+		videos.append(video)
+	return(videos)
+
+# Get all youtube videos belonging to the configured YouTube channel. Search results are paged through on this
+# thread while the statistics for pages already found are fetched by worker threads
+def my_yt_videos(workers=4):
+	youtube = yt_service()
+	query = {
+		'type' : 'video',
+		'channelId' : lyf.get_config('GOOGLE_ANALYTICS', 'YouTube_Channel'),
+		'part' : 'id',
+		'maxResults' : 50
+	}
+
+	pool = ThreadPool(workers)
+	try:
+		pending = []
+		while True:
+			with trace.span('extract', 'yt_search') as span:
+				results = ga.ga_execute(youtube.search().list(**query))
+				span.add(rows=len(results.get('items', [])))
+			video_ids = [item['id']['videoId'] for item in results.get('items', [])]
+			if len(video_ids) > 0:
+				pending.append(pool.apply_async(fetch_yt_videos, (video_ids,)))
+
+			if not results.has_key('nextPageToken'):
+				break
+			query['pageToken'] = results['nextPageToken']
+
+		videos = []
+		for result in pending:
+			videos.extend(result.get())
+	finally:
+		pool.terminate()
+
+	return(videos)
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Run the daily ETL jobs in one process as a dependency graph, sharing connection pools and API sessions
+import lyf, logging
+import argparse
+import json
+import time
+import sys
+import threading
+
+from lyf import psql, trace
+from datetime import date, timedelta, datetime	# Date time
+from multiprocessing.pool import ThreadPool	# Worker threads for concurrent jobs
+
+import f_twitter_daily, f_facebook_daily, f_youtube_daily, f_mc_lists_daily, d_mc_campaigns, load_ga_dims, load_ga_fact
+
+parser = argparse.ArgumentParser(description="Run the daily ETL jobs")
+parser.add_argument("-j", "--jobs", nargs='+', default=None, help="Only run these jobs, as well as the jobs they depend on.")
+parser.add_argument("-p", "--parallel", type=int, default=4, help="Number of jobs to run concurrently.")
+parser.add_argument("-t", "--timeout", type=int, default=3600, help="Default time limit for each job in seconds.")
+parser.add_argument("-r", "--report", default=None, help="File to write the JSON run report to, instead of stdout.")
+parser.add_argument("-m", "--metrics", default=None, help="File to write stage and API metrics to in Prometheus text format.")
+
+# Jobs with their entry point, the jobs they must run after and any time limit in seconds overriding the default
+JOBS = {
+	'f_twitter_daily' : { 'main' : f_twitter_daily.main, 'depends' : [] },
+	'f_facebook_daily' : { 'main' : f_facebook_daily.main, 'depends' : [] },
+	'f_youtube_daily' : { 'main' : f_youtube_daily.main, 'depends' : [] },
+	'f_mc_lists_daily' : { 'main' : f_mc_lists_daily.main, 'depends' : [] },
+	'd_mc_campaigns' : { 'main' : d_mc_campaigns.main, 'depends' : [] },
+	'load_ga_dims' : { 'main' : load_ga_dims.main, 'depends' : [] },
+	'load_ga_fact' : { 'main' : load_ga_fact.main, 'depends' : ['load_ga_dims'] }
+}
+
+# Worker thread of each job, and jobs which have overrun their time limit, so that their work can be cancelled
+JOB_THREADS = {}
+ABANDONED = set()
+
+# Seconds to wait for cancelled jobs to give their connections back
+CANCEL_GRACE = 10
+
+# Run a single job on a worker thread. Jobs log their own errors and return the number of rows loaded, or None
+def run_job(name):
+	start = time.time()
+	thread = threading.current_thread().ident
+	psql.uncancel_thread(thread) # Cancelled for an earlier job on this thread
+	JOB_THREADS[name] = thread
+	if name in ABANDONED:
+		return({ 'status' : 'timeout', 'rows' : None, 'error' : 'Timed out before starting.', 'duration' : 0 })
+
+	try:
+		rows = JOBS[name]['main']()
+		error = None
+	except Exception as err:
+		rows = None
+		error = str(err)
+	status = 'failed' if rows is None else 'succeeded'
+	return({ 'status' : status, 'rows' : rows, 'error' : error, 'duration' : round(time.time() - start, 3) })
+
+# Gets the jobs to run, including any that the selected ones depend on
+def select_jobs(names):
+	if names is None:
+		return(JOBS.keys())
+
+	selected = set()
+	pending = list(names)
+	while len(pending) > 0:
+		name = pending.pop()
+		if name not in JOBS:
+			raise ValueError('Unknown job: %s' % name)
+		if name not in selected:
+			selected.add(name)
+			pending.extend(JOBS[name]['depends'])
+	return(list(selected))
+
+# Run jobs as soon as the jobs they depend on have succeeded. Jobs still running after their time limit have their
+# database work cancelled and are abandoned, as threads cannot be killed, and anything depending on a failed job is
+# skipped. Returns a report for each job
+def run_jobs(names, parallel, timeout):
+	pool = ThreadPool(max(1, parallel))
+	report = {}
+	running = {}
+	abandoned = []
+	waiting = list(names)
+
+	try:
+		while len(waiting) > 0 or len(running) > 0:
+			# Start or skip any jobs whose dependencies have finished
+			for name in list(waiting):
+				depends = [dep for dep in JOBS[name]['depends'] if dep in names]
+				if any([dep in report and report[dep]['status'] != 'succeeded' for dep in depends]):
+					report[name] = { 'status' : 'skipped', 'rows' : None, 'error' : 'Dependency failed.', 'duration' : 0 }
+					waiting.remove(name)
+					logging.error('Job %s skipped.' % name)
+				elif all([dep in report for dep in depends]):
+					limit = JOBS[name].get('timeout', timeout)
+					running[name] = (pool.apply_async(run_job, (name,)), time.time() + limit)
+					waiting.remove(name)
+
+			# Collect finished and timed out jobs
+			time.sleep(0.1)
+			for name, (result, deadline) in running.items():
+				if result.ready():
+					report[name] = result.get()
+				elif time.time() > deadline:
+					report[name] = { 'status' : 'timeout', 'rows' : None, 'error' : 'Timed out.', \
+						'duration' : JOBS[name].get('timeout', timeout) }
+					ABANDONED.add(name)
+					if name in JOB_THREADS:
+						psql.cancel_thread(JOB_THREADS[name])
+					abandoned.append(result)
+				else:
+					continue
+				del running[name]
+				if report[name]['status'] == 'succeeded':
+					logging.info('Job %s succeeded, loading %s rows in %ss.' % (name, report[name]['rows'], report[name]['duration']))
+				else:
+					logging.error('Job %s %s.' % (name, report[name]['status']))
+
+		# Give cancelled jobs a moment to fail and return their connections
+		for result in abandoned:
+			result.wait(CANCEL_GRACE)
+	finally:
+		pool.terminate()
+	return(report)
+
+def main():
+	args = parser.parse_args()
+	started = datetime.now()
+	start = time.time()
+
+	jobs = run_jobs(select_jobs(args.jobs), args.parallel, args.timeout)
+	report = {
+		'started' : started.strftime('%Y-%m-%d %H:%M:%S'),
+		'duration' : round(time.time() - start, 3),
+		'succeeded' : all([job['status'] == 'succeeded' for job in jobs.values()]),
+		'jobs' : jobs,
+		'stages' : trace.report()['stages'],
+		'api' : lyf.api_stats()
+	}
+	if not psql.close_pool():
+		logging.warning('Left the connection pool open, as timed out jobs still hold connections.')
+
+	if args.report is None:
+		print(json.dumps(report, indent=2, sort_keys=True))
+	else:
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+	if args.metrics is not None:
+		trace.write_prometheus(args.metrics)
+
+	if not report['succeeded']:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	lyf.setup_logging()
+	main()
@@ -252,3 +252,12 @@ CREATE TABLE lyf.d_mc_campaigns (
 	opens INTEGER,
 	PRIMARY KEY (campaign_id)
 );
+
+-- ETL watermarks: last complete date loaded into each table
+DROP TABLE IF EXISTS lyf.etl_watermark;
+CREATE TABLE lyf.etl_watermark (
+	table_name VARCHAR NOT NULL,
+	last_date DATE NOT NULL,
+	updated TIMESTAMP,
+	PRIMARY KEY (table_name)
+);
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# Tests for the dimension key cache, against a stub database rather than PostgreSQL
+
+import unittest
+
+from lyf import psql
+
+# Stub database holding a dimension as a dictionary of natural keys to surrogate keys
+class StubDB():
+	# Initialiser
+	def __init__(self, keys):
+		self.keys = keys
+		self.cursor = self
+		self.lookups = []
+		self.rows = []
+
+	def execute(self, sql, values=[]):
+		self.lookups.append(sorted(values[0]))
+		self.rows = [(val, self.keys[val]) for val in values[0] if val in self.keys]
+		return(1)
+
+	def fetchall(self):
+		return(self.rows)
+
+class DimCacheTest(unittest.TestCase):
+	def test_lru_keeps_hits_evicted_by_fetched_keys(self):
+		db = StubDB({ 'A' : 1, 'B' : 2, 'C' : 3, 'D' : 4 })
+		cache = psql.DimCache(db, 'lyf.d_ga_source', 'source_medium', 'source_id', max_size=2)
+		self.assertEqual(cache.resolve(['A', 'B']), [1, 2])
+		self.assertEqual(cache.resolve(['A', 'C', 'D']), [1, 3, 4])
+		self.assertEqual(db.lookups, [['A', 'B'], ['C', 'D']])
+		self.assertEqual(len(cache.keys), 2)
+
+	def test_lru_unknown_and_unset_values(self):
+		db = StubDB({ 'A' : 1 })
+		cache = psql.DimCache(db, 'lyf.d_ga_source', 'source_medium', 'source_id', max_size=2)
+		self.assertEqual(cache.resolve(['A', 'Z', None, '(not set)', 'A']), [1, -1, -1, -1, 1])
+
+if __name__ == '__main__':
+	unittest.main()